@@ -0,0 +1,119 @@
+"""Benchmark of the FRESQ harvest against a local mock server.
+
+Usage: python bench_extract.py [nb_records_per_code] [latency_ms] [workers,...] [rate_limit]
+
+rate_limit is the HTTP_RATE_LIMIT of the mock host in requests/s, 0 (default) for none.
+"""
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+NB_RECORDS = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+LATENCY = (int(sys.argv[2]) if len(sys.argv) > 2 else 20) / 1000
+WORKERS = [int(k) for k in sys.argv[3].split(',')] if len(sys.argv) > 3 else [1, 4, 8, 16, 32]
+RATE_LIMIT = float(sys.argv[4]) if len(sys.argv) > 4 else 0
+NB_PARCOURS, NB_ETAPES = 2, 4
+PAGE_SIZE = 100
+NB_UAIS = 37
+
+
+class MockFresqServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+
+class MockFresqHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def send_json(self, payload):
+        time.sleep(LATENCY)
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        path = urlparse(self.path).path
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length)
+        if path == '/auth':
+            return self.send_json({'access_token': 'token', 'expires_in': 300})
+        if path == '/api/recherche':
+            params = json.loads(body)
+            code = params['codesTypeDiplome'][0]
+            page = params['pageNumber']
+            records = [{'recordId': f'{code}-{k}', 'data': {'code_type_diplome': code, 'inf': f'{code}{k}',
+                                                             'uai_etablissement': f'{k % NB_UAIS:07d}A'}}
+                       for k in range(NB_RECORDS)]
+            records.sort(key=lambda d: d['data']['uai_etablissement'], reverse=params['sortDirection'] == 'DESC')
+            if params['uais']:
+                records = [d for d in records if d['data']['uai_etablissement'] in params['uais']]
+            return self.send_json({'totalPages': -(-len(records) // PAGE_SIZE), 'totalElements': len(records),
+                                   'content': records[page * PAGE_SIZE:(page + 1) * PAGE_SIZE]})
+        self.send_error(404)
+
+    def do_GET(self):
+        parts = urlparse(self.path).path.strip('/').split('/')
+        if parts[1:] == ['referentiels', 'type_diplome']:
+            return self.send_json({'datas': [{'data': {'code': c}} for c in ['BUT', 'M', 'LP']]})
+        if parts[1] == 'diplomes':
+            technical_id = parts[3]
+            return self.send_json({'data': {
+                'id': technical_id,
+                'parcours_diplomants': [f'{technical_id}-p{k}' for k in range(NB_PARCOURS)],
+                'etapes': [f'{technical_id}-e{k}' for k in range(NB_ETAPES)]}})
+        if parts[1] == 'parcours-diplomants':
+            return self.send_json({'data': {'id': parts[2], 'code_sise': '1234567'}})
+        if parts[1] == 'etapes' and len(parts) == 4:
+            return self.send_json({'sites': {'data': {'uai': parts[2]}}})
+        if parts[1] == 'etapes':
+            return self.send_json({'data': {'id': parts[2], 'intitule': f'etape {parts[2]}'}})
+        self.send_error(404)
+
+
+def main():
+    server = MockFresqServer(('127.0.0.1', 0), MockFresqHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f'http://127.0.0.1:{server.server_port}'
+    os.environ['FRESQ_AUTHENT_URL'] = f'{base_url}/auth'
+    os.environ['FRESQ_BASE_URL'] = base_url
+    os.environ['FRESQ_DETAILS_URL'] = base_url
+    tmp_dir = tempfile.mkdtemp()
+    os.environ['FRESQ_CACHE_PATH'] = os.path.join(tmp_dir, 'bench_cache.sqlite')
+    os.environ['FRESQ_EXTRACT_DIR'] = os.path.join(tmp_dir, 'fresq_extract')
+
+    from project.server.main import extract, http_client
+    http_client.HTTP_RATE_LIMIT = RATE_LIMIT
+    http_client.HTTP_RATE_LIMITS.clear()
+
+    rate_limit = f'{RATE_LIMIT:.0f} requests/s' if RATE_LIMIT > 0 else 'no'
+    print(f'{NB_RECORDS} records per code, {LATENCY * 1000:.0f} ms latency, {rate_limit} rate limit')
+    reference = None
+    for nb_workers in WORKERS:
+        for cache in [extract.cache_formation, extract.cache_parcours, extract.cache_etape]:
+            cache.clear()
+        extract.FRESQ_NB_DETAIL_WORKERS = 2 * nb_workers
+        extract.detail_executor = None
+        start = time.time()
+        data = extract.get_full_data(nb_workers=nb_workers)
+        delta = time.time() - start
+        if reference is None:
+            reference = data
+        assert data == reference
+        print(f'workers={nb_workers:>3} | {len(data)} records in {delta:.1f}s | {len(data) / delta:.1f} records/s')
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+"""Benchmark of the elastic bulk loader against a local mock server.
+
+The mock rejects a share of the documents with 429, all of them must end up indexed.
+The baseline sends sequential bulks of 100 documents, as elasticdump --limit 100 did.
+
+Usage: python bench_load.py [nb_docs] [latency_ms] [reject_rate] [workers,...]
+"""
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+NB_DOCS = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+LATENCY = (int(sys.argv[2]) if len(sys.argv) > 2 else 20) / 1000
+REJECT_RATE = float(sys.argv[3]) if len(sys.argv) > 3 else 0.02
+WORKERS = [int(k) for k in sys.argv[4].split(',')] if len(sys.argv) > 4 else [1, 4, 8]
+
+
+class MockElasticServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.lock = threading.Lock()
+        self.docs = {}
+
+
+class MockElasticHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def send_json(self, payload):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('X-Elastic-Product', 'Elasticsearch')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self.send_json({'version': {'number': '7.8.0', 'build_flavor': 'default'}, 'tagline': 'You Know, for Search'})
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        lines = self.rfile.read(length).decode('utf-8').splitlines()
+        index_name = self.path.strip('/').split('/')[0]
+        time.sleep(LATENCY)
+        items = []
+        for source in lines[1::2]:
+            if random.random() < REJECT_RATE:
+                items.append({'index': {'_index': index_name, 'status': 429,
+                                        'error': {'type': 'es_rejected_execution_exception'}}})
+                continue
+            doc = json.loads(source)
+            with self.server.lock:
+                self.server.docs.setdefault(index_name, {})[doc['id']] = doc
+            items.append({'index': {'_index': index_name, 'status': 201}})
+        self.send_json({'took': 1, 'errors': any(item['index']['status'] >= 300 for item in items), 'items': items})
+
+
+def main():
+    server = MockElasticServer(('127.0.0.1', 0), MockElasticHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    os.environ['ES_URL'] = f'http://127.0.0.1:{server.server_port}'
+    os.environ['ES_LOGIN_FRESQ_BACK'] = os.environ['ES_PASSWORD_FRESQ_BACK'] = 'bench'
+    os.environ['ES_BULK_INITIAL_BACKOFF'] = '0.1'
+
+    from elasticsearch import helpers
+    from project.server.main import load
+    from project.server.main.elastic import get_client
+
+    filename = os.path.join(tempfile.mkdtemp(), 'bench_load.jsonl')
+    with open(filename, 'w') as f:
+        for k in range(NB_DOCS):
+            f.write(json.dumps({'id': k, 'inf': f'INF{k}', 'label': 'formation ' * random.randint(10, 200)}) + '\n')
+
+    print(f'{NB_DOCS} documents, {LATENCY * 1000:.0f} ms latency, {REJECT_RATE:.0%} rejected with 429')
+    start = time.time()
+    _, errors = helpers.bulk(get_client(), load.iter_jsonl_lines(filename), chunk_size=100, index='baseline',
+                             raise_on_error=False, stats_only=True)
+    delta = time.time() - start
+    print(f'baseline    | {len(server.docs.get("baseline", {}))} indexed, {errors} lost in {delta:.1f}s | {NB_DOCS / delta:.0f} docs/s')
+    for nb_workers in WORKERS:
+        index_name = f'bench-{nb_workers}'
+        start = time.time()
+        nb_indexed = load.bulk_load(index_name, load.iter_jsonl_lines(filename), nb_workers=nb_workers)
+        delta = time.time() - start
+        assert nb_indexed == NB_DOCS == len(server.docs[index_name])
+        print(f'workers={nb_workers:>3} | {nb_indexed} indexed in {delta:.1f}s | {NB_DOCS / delta:.0f} docs/s')
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+"""Benchmark and golden check of utils.normalize against the former implementation.
+
+Usage: python bench_normalize.py [fresq_raw_xxx.json.gz]
+
+The corpus is every intitule_officiel of the raw dump if one is given, plus synthetic strings.
+"""
+import gzip
+import random
+import re
+import string
+import sys
+import time
+
+from project.server.main import utils
+from project.server.main.utils import iter_json_array, normalize, normalize_batch, normalize_str
+
+
+def remove_punction_legacy(s):
+    for p in string.punctuation:
+        s = s.replace(p, ' ').replace('  ', ' ')
+    return s.strip()
+
+
+def normalize_legacy(x, remove_space=True, min_length=0):
+    if not isinstance(x, str):
+        return ''
+    normalized = utils.normalizer.normalize_str(x)
+    normalized = normalized.replace('\n', ' ')
+    normalized = re.sub(' +', ' ', normalized)
+    normalized = remove_punction_legacy(normalized)
+    normalized = normalized.replace("’", "'")
+    normalized = " ".join([e[0] for e in utils.pre_tokenizer.pre_tokenize_str(normalized) if len(e[0]) > min_length])
+    if remove_space:
+        normalized = normalized.strip().replace(' ', '')
+    return normalized
+
+
+def get_corpus():
+    corpus = []
+    if len(sys.argv) > 1:
+        with gzip.open(sys.argv[1], 'rt') as f:
+            for e in iter_json_array(f):
+                corpus.append(e.get('data', {}).get('intitule_officiel'))
+    rng = random.Random(0)
+    alphabet = string.ascii_letters + string.digits + string.punctuation + ' \t\n' + 'éèêàçôÉÈœæ’‘“”«»–—…  ​́中文° ²'
+    words = ['Master', 'Licence professionnelle', "Sciences de l'éducation", 'Métiers de l’enseignement, 2nd degré',
+             'Droit - Économie - Gestion', 'BUT GEA (Gestion des entreprises)', 'Génie   civil', 'Santé/STAPS']
+    for _ in range(20000):
+        if rng.random() < 0.5:
+            corpus.append(' '.join(rng.choice(words) for _ in range(rng.randrange(1, 4))))
+        else:
+            corpus.append(''.join(rng.choice(alphabet) for _ in range(rng.randrange(0, 60))))
+    corpus += [None, 12, '', ' ', '\n']
+    return corpus
+
+
+def main():
+    corpus = get_corpus()
+    nb_distinct = len(set([x for x in corpus if isinstance(x, str)]))
+    print(f'{len(corpus)} strings, {nb_distinct} distinct')
+    for remove_space, min_length in [(True, 0), (False, 0), (False, 2)]:
+        start = time.time()
+        legacy = [normalize_legacy(x, remove_space, min_length) for x in corpus]
+        delta_legacy = time.time() - start
+        normalize_str.cache_clear()
+        start = time.time()
+        new = [normalize(x, remove_space, min_length) for x in corpus]
+        delta_new = time.time() - start
+        start = time.time()
+        new_memo = [normalize(x, remove_space, min_length) for x in corpus]
+        delta_memo = time.time() - start
+        batch = normalize_batch(corpus, remove_space, min_length)
+        assert legacy == new == new_memo == batch
+        print(f'remove_space={remove_space}, min_length={min_length}: identical | legacy {delta_legacy:.2f}s, '
+              f'single pass {delta_new:.2f}s, memoized {delta_memo:.3f}s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,123 @@
+"""Benchmark of format.enrich_with_search against the former implementation.
+
+Usage: python bench_search.py [fresq_formatted_xxx.jsonl] [nb_largest]
+
+Runs on the nb_largest formations (by number of etapes) of a formatted file if given,
+otherwise on synthetic formations with many etapes.
+"""
+import copy
+import json
+import random
+import sys
+import time
+
+from project.server.main.format import enrich_with_search
+
+NB_LARGEST = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+SET_FIELDS = ['pedagogicalInfoKeywords', 'pedagogicalInfoKeywordsdisciplines', 'pedagogicalInfoKeywordsjobs',
+              'pedagogicalInfoKeywordssectors', 'recruitmentInfoExpectations']
+
+
+def enrich_with_search_legacy(formation):
+    search_elt = {}
+    for search_info, fields in [('romeInfos', ['codeRome', 'idLevel1', 'level1', 'idLevel2', 'level2', 'level3', 'label', 'ogr', 'rncp']),
+                                ('rncpInfos', ['rncp', 'typeEmploiAccessibles']), ('etapes', ['infe', 'label']),
+                                ('parcours', ['infp', 'label']),
+                                ('etablissements', ['uai', 'name', 'shortName', 'sigle', 'paysageName', 'city'])]:
+        search_elt[search_info] = {}
+        if not isinstance(formation.get(search_info), list):
+            continue
+        for e in formation.get(search_info):
+            for f in fields:
+                if f not in search_elt[search_info]:
+                    search_elt[search_info][f] = []
+                if f in e and e[f] not in search_elt[search_info][f]:
+                    search_elt[search_info][f].append(e[f])
+                if search_info == 'etablissements' and f == 'paysageName':
+                    if 'paysageElt' in e and isinstance(e['paysageElt'].get('name'), str) and e['paysageElt'].get('name') not in search_elt[search_info]['paysageName']:
+                        search_elt[search_info]['paysageName'].append(e['paysageElt'].get('name'))
+                if search_info == 'etablissements' and f == 'city':
+                    if 'address' in e and isinstance(e['address'].get('city'), str) and e['address'].get('city') not in search_elt[search_info]['city']:
+                        search_elt[search_info]['city'].append(e['address'].get('city'))
+            if search_info != 'etapes':
+                continue
+            if 'pedagogicalInfo' in e and isinstance(e['pedagogicalInfo'], dict):
+                for k in ['keywords', 'keywordsDisciplines', 'keywordsJobs', 'keywordsSectors']:
+                    if isinstance(e['pedagogicalInfo'].get(k), list):
+                        current_field = f'pedagogicalInfo{k.capitalize()}'
+                        if current_field not in search_elt[search_info]:
+                            search_elt[search_info][current_field] = []
+                        search_elt[search_info][current_field] += e['pedagogicalInfo'].get(k)
+                        search_elt[search_info][current_field] = list(set(search_elt[search_info][current_field]))
+            if 'recruitmentInfo' in e and isinstance(e['recruitmentInfo'], dict) and isinstance(e['recruitmentInfo'].get('expectations'), list):
+                current_field = 'recruitmentInfoExpectations'
+                if current_field not in search_elt[search_info]:
+                    search_elt[search_info][current_field] = []
+                search_elt[search_info][current_field] += e['recruitmentInfo'].get('expectations')
+                search_elt[search_info][current_field] = list(set(search_elt[search_info][current_field]))
+    for search_info in ['inf', 'label', 'disciplinarySector']:
+        search_elt[search_info] = formation.get(search_info)
+    formation['search'] = search_elt
+    return formation
+
+
+def get_synthetic_formations():
+    rng = random.Random(0)
+    vocabulary = [f'mot clé {k}' for k in range(3000)]
+    formations = []
+    for k in range(NB_LARGEST):
+        etapes = []
+        for j in range(rng.randrange(20, 120)):
+            etapes.append({
+                'infe': f'E{k}-{j}', 'label': f'Etape {j % 30}',
+                'pedagogicalInfo': {kw: rng.sample(vocabulary, 30) for kw in ['keywords', 'keywordsDisciplines', 'keywordsJobs', 'keywordsSectors']},
+                'recruitmentInfo': {'expectations': rng.sample(vocabulary, 10)},
+            })
+        formations.append({
+            'inf': f'INF{k}', 'label': f'Master {k}', 'etapes': etapes,
+            'parcours': [{'infp': f'P{k}-{j}', 'label': f'Parcours {j % 10}'} for j in range(40)],
+            'romeInfos': [{'codeRome': f'M{j % 50}', 'label': f'métier {j}', 'rncp': f'RNCP{j % 5}'} for j in range(200)],
+            'rncpInfos': [{'rncp': f'RNCP{j}', 'typeEmploiAccessibles': 'emplois'} for j in range(5)],
+            'etablissements': [{'uai': f'{j:07d}A', 'name': f'etab {j}', 'paysageElt': {'name': f'p{j}'}, 'address': {'city': 'Paris'}} for j in range(5)],
+        })
+    return formations
+
+
+def get_formations():
+    if len(sys.argv) < 2:
+        return get_synthetic_formations()
+    with open(sys.argv[1]) as f:
+        formations = [json.loads(line) for line in f]
+    formations.sort(key=lambda x: -len(x.get('etapes') or []))
+    return formations[:NB_LARGEST]
+
+
+def main():
+    formations = get_formations()
+    nb_etapes = sum(len(f.get('etapes') or []) for f in formations)
+    legacy_input, new_input = copy.deepcopy(formations), copy.deepcopy(formations)
+    start = time.time()
+    legacy = [enrich_with_search_legacy(f)['search'] for f in legacy_input]
+    delta_legacy = time.time() - start
+    start = time.time()
+    new = [enrich_with_search(f)['search'] for f in new_input]
+    delta_new = time.time() - start
+    for a, b in zip(legacy, new):
+        assert list(a.keys()) == list(b.keys())
+        for search_info in a:
+            if not isinstance(a[search_info], dict):
+                assert a[search_info] == b[search_info]
+                continue
+            assert list(a[search_info].keys()) == list(b[search_info].keys())
+            for f in a[search_info]:
+                if f in SET_FIELDS:
+                    # former order was the set order, only the content is compared
+                    assert sorted(a[search_info][f]) == sorted(b[search_info][f])
+                else:
+                    assert a[search_info][f] == b[search_info][f]
+    print(f'{len(formations)} formations, {nb_etapes} etapes: same search fields')
+    print(f'legacy {delta_legacy:.2f}s, ordered sets {delta_new:.2f}s ({delta_legacy / delta_new:.1f}x)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+"""Micro-benchmark of sise.get_sise_elt against the former full-scan filter, on synthetic SISE data.
+
+Usage: python bench_sise.py [nb_sise_rows] [nb_lookups]
+"""
+import random
+import sys
+import time
+
+import pandas as pd
+
+from project.server.main import sise
+
+NB_ROWS = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+NB_LOOKUPS = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+NB_UAIS, NB_INFS = 3000, 20000
+
+
+def get_synthetic_sise():
+    rng = random.Random(0)
+    rows = []
+    for _ in range(NB_ROWS):
+        rows.append({
+            'annee_universitaire': rng.choice(['2021-22', '2022-23']),
+            'uai_fresq': '/'.join(f'{rng.randrange(NB_UAIS):07d}A' for _ in range(rng.choice([1, 1, 2]))),
+            'inf': '/'.join(f'INF{rng.randrange(NB_INFS)}' for _ in range(rng.choice([1, 1, 1, 2]))) if rng.random() > 0.05 else None,
+            'gd_disciscipline_lib': rng.choice(['Sciences', 'Lettres', 'Droit', 'Santé']),
+            'discipline_lib': f'discipline {rng.randrange(40)}',
+            'sect_disciplinaire_lib': f'secteur {rng.randrange(100)}',
+            'disciplines_selection': rng.choice(['A', 'B', 'C', None]),
+        })
+    df_sise = pd.DataFrame(rows)
+    df_sise['uai_fresq_split'] = df_sise.uai_fresq.fillna('').str.split('/')
+    df_sise['inf_split'] = df_sise.inf.fillna('').str.split('/')
+    df_sise_dict = {'all': df_sise}
+    for a in df_sise['annee_universitaire'].unique():
+        df_sise_dict[a] = df_sise[df_sise['annee_universitaire'] == a]
+    return df_sise_dict
+
+
+def get_sise_elt_full_scan(df_sise_dict, uais, inf, annee):
+    # former implementation, two apply over the whole table for each lookup
+    empty_ans = {'avec_sise_infos': False}
+    if (uais is None) or len(uais) == 0:
+        empty_ans['sise_matching'] = 'no_uai'
+        return empty_ans
+    df_sise_annee = df_sise_dict[annee]
+    uais_set = set(uais)
+    filter_uai = df_sise_annee.uai_fresq_split.apply(lambda x: bool(set(x) & uais_set))
+    filter_inf = df_sise_annee.inf_split.apply(lambda x: inf in x)
+    df_sise_final = df_sise_annee[filter_uai & filter_inf]
+    if len(df_sise_final) == 0:
+        return empty_ans
+    ans = {'avec_sise_infos': True}
+    for k in sise.SISE_FIELDS:
+        ans[k] = df_sise_final[k].value_counts().index.to_list()
+    return ans
+
+
+def main():
+    df_sise_dict = get_synthetic_sise()
+    sise.df_sise_dict, sise.years_in_sise = df_sise_dict, []
+    df_all = df_sise_dict['all']
+    rng = random.Random(1)
+    lookups = []
+    for _ in range(NB_LOOKUPS):
+        row = df_all.iloc[rng.randrange(len(df_all))]
+        if rng.random() < 0.7:
+            # existing (inf, uai) couple, sometimes with an extra uai
+            uais = list(row.uai_fresq_split) + ([f'{rng.randrange(NB_UAIS):07d}A'] if rng.random() < 0.3 else [])
+            inf = rng.choice(row.inf_split)
+        else:
+            uais = [f'{rng.randrange(NB_UAIS):07d}A']
+            inf = f'INF{rng.randrange(NB_INFS)}'
+        lookups.append((uais if rng.random() > 0.02 else [], inf))
+
+    nb_reference = min(NB_LOOKUPS, 200)
+    start = time.time()
+    reference = [get_sise_elt_full_scan(df_sise_dict, uais, inf, 'all') for uais, inf in lookups[:nb_reference]]
+    delta_scan = (time.time() - start) / nb_reference
+
+    start = time.time()
+    sise.get_sise_index('all')
+    delta_index = time.time() - start
+    start = time.time()
+    answers = [sise.get_sise_elt(uais, inf, 'all') for uais, inf in lookups]
+    delta_lookup = (time.time() - start) / NB_LOOKUPS
+
+    assert answers[:nb_reference] == reference
+    nb_matched = len([a for a in answers if a['avec_sise_infos']])
+    print(f'{NB_ROWS} SISE rows, {NB_LOOKUPS} lookups ({nb_matched} matched), {nb_reference} checked against the full scan')
+    print(f'full scan: {delta_scan * 1e3:.2f} ms / lookup')
+    print(f'index: built in {delta_index:.2f}s, {delta_lookup * 1e6:.0f} µs / lookup')
+
+
+if __name__ == '__main__':
+    main()
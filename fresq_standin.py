@@ -0,0 +1,106 @@
+"""Offline FRESQ / Paysage stand-in.
+
+    python fresq_standin.py record cassette.jsonl.gz [--limit 500]
+        harvests FRESQ and Paysage (live credentials needed) and records the answers
+    python fresq_standin.py serve cassette.jsonl.gz [--port 8000] [--latency 50] [--error-rate 0.01]
+        replays the cassette on a local server
+    python fresq_standin.py bench cassette.jsonl.gz [--limit 500] [--workers 1,8,32] [--latency 50]
+        benchmarks the extraction and get_etabs end-to-end against the replayed cassette
+
+Nothing is uploaded to nor downloaded from the object storage, all files are written in a temporary directory.
+"""
+import argparse
+import gzip
+import json
+import os
+import tempfile
+import time
+
+from project.server.main.utils import get_raw_data_filename
+from project.server.main.standin import Cassette, CassetteRecorder, StandinServer
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('mode', choices=['record', 'serve', 'bench'])
+    parser.add_argument('cassette')
+    parser.add_argument('--limit', type=int, default=0, help='nb of records harvested, 0 for all')
+    parser.add_argument('--workers', default='1,8,32')
+    parser.add_argument('--port', type=int, default=0)
+    parser.add_argument('--latency', type=float, default=0, help='in ms')
+    parser.add_argument('--error-rate', type=float, default=0)
+    return parser.parse_args()
+
+
+def offline(modules):
+    for module in modules:
+        for f in ['upload_object', 'download_object', 'copy_object']:
+            if hasattr(module, f):
+                setattr(module, f, lambda *args, **kwargs: None)
+
+
+def harvest(extract, paysage, limit, nb_workers):
+    for cache in [extract.cache_formation, extract.cache_parcours, extract.cache_etape, paysage.cache_paysage_uai]:
+        cache.clear()
+    extract.FRESQ_NB_DETAIL_WORKERS = 2 * nb_workers
+    extract.detail_executor = None
+    extract.known_uais = None
+    start = time.time()
+    data = []
+    for c in extract.get_code_diplomes():
+        data += extract.get_data(c)
+    if limit:
+        data = data[:limit]
+    extract.get_formations_details(data, {}, nb_workers)
+    extract_time = time.time() - start
+    # local raw dump, as read back by get_etabs
+    with gzip.open(get_raw_data_filename('standin'), 'wt') as f:
+        json.dump(data, f)
+    start = time.time()
+    paysage.get_etabs('standin')
+    etabs_time = time.time() - start
+    return data, extract_time, etabs_time
+
+
+def main():
+    args = get_args()
+    cassette = Cassette(os.path.abspath(args.cassette))
+    if args.mode != 'record':
+        cassette.load()
+        server = StandinServer(cassette, port=args.port, latency=args.latency / 1000, error_rate=args.error_rate)
+        os.environ.update(server.get_env())
+        if args.mode == 'serve':
+            print(f'serving {args.cassette} on {server.url}')
+            for k, v in server.get_env().items():
+                print(f'export {k}={v}')
+            # a single serve loop, in the main thread until interrupted
+            try:
+                server.serve_forever()
+            except KeyboardInterrupt:
+                pass
+            server.server_close()
+            return
+        server.start()
+    os.chdir(tempfile.mkdtemp())
+    os.environ['FRESQ_CACHE_PATH'] = os.path.abspath('standin_cache.sqlite')
+
+    from project.server.main import extract, http_client, paysage, utils
+    offline([extract, paysage, utils])
+
+    if args.mode == 'record':
+        http_client.set_recorder(CassetteRecorder(cassette))
+        data, _, _ = harvest(extract, paysage, args.limit, int(args.workers.split(',')[-1]))
+        cassette.save()
+        print(f'{len(data)} records harvested, {len(cassette.interactions)} answers recorded in {args.cassette}')
+        return
+
+    for nb_workers in [int(k) for k in args.workers.split(',')]:
+        data, extract_time, etabs_time = harvest(extract, paysage, args.limit, nb_workers)
+        print(f'workers={nb_workers:>3} | extract {len(data)} records in {extract_time:.1f}s '
+              f'({len(data) / extract_time:.1f} records/s) | get_etabs in {etabs_time:.1f}s')
+    print(f'{server.nb_requests} requests served, {server.nb_errors} errors injected, {server.nb_missing} not recorded')
+    http_client.log_stats()
+
+
+if __name__ == '__main__':
+    main()
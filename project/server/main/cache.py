@@ -0,0 +1,139 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+
+from project.server.main.logger import get_logger
+
+logger = get_logger(__name__)
+
+CACHE_PATH = os.getenv('FRESQ_CACHE_PATH', 'fresq_cache.sqlite')
+# entries older than that are ignored and evicted - default keeps a crashed or resumed run
+# within the day cheap, while the next nightly run still gets fresh data
+CACHE_MAX_AGE = int(os.getenv('FRESQ_CACHE_MAX_AGE', 20 * 3600))
+CACHE_MAX_SIZE = int(os.getenv('FRESQ_CACHE_MAX_SIZE', 0))
+
+connections = {}
+connections_lock = threading.Lock()
+
+
+def get_connection(path: str) -> sqlite3.Connection:
+    with connections_lock:
+        if path not in connections:
+            connection = sqlite3.connect(path, timeout=60, check_same_thread=False, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            connection.execute('CREATE TABLE IF NOT EXISTS cache ('
+                               'namespace TEXT NOT NULL, key TEXT NOT NULL, value BLOB NOT NULL, '
+                               'size INTEGER NOT NULL, created_at REAL NOT NULL, '
+                               'PRIMARY KEY (namespace, key))')
+            connection.execute('CREATE INDEX IF NOT EXISTS cache_created_at ON cache (created_at)')
+            logger.debug(f'persistent cache opened at {path}')
+            connections[path] = connection
+        return connections[path]
+
+
+def close_connections() -> None:
+    """Close the SQLite connections, they are opened again on the next access."""
+    with connections_lock:
+        for connection in connections.values():
+            connection.close()
+        connections.clear()
+
+
+class PersistentCache:
+    """Dict-like JSON cache persisted in SQLite, with max-age eviction and size accounting.
+
+    Several caches (namespaces) share the same SQLite file. Values are stored as
+    zlib-compressed JSON, so what is read back is a copy of what was stored.
+    """
+
+    def __init__(self, namespace: str, path: str = CACHE_PATH, max_age: int = CACHE_MAX_AGE):
+        self.namespace = namespace
+        self.path = path
+        self.max_age = max_age
+        self.lock = threading.Lock()
+
+    def _execute(self, query: str, params: tuple = ()) -> list:
+        with self.lock:
+            return get_connection(self.path).execute(query, params).fetchall()
+
+    def _min_created_at(self) -> float:
+        if not self.max_age:
+            return 0
+        return time.time() - self.max_age
+
+    def get(self, key: str, default=None):
+        rows = self._execute('SELECT value FROM cache WHERE namespace = ? AND key = ? AND created_at >= ?',
+                             (self.namespace, key, self._min_created_at()))
+        if not rows:
+            return default
+        return json.loads(zlib.decompress(rows[0][0]))
+
+    def __getitem__(self, key: str):
+        value = self.get(key, KeyError)
+        if value is KeyError:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key: str) -> bool:
+        rows = self._execute('SELECT 1 FROM cache WHERE namespace = ? AND key = ? AND created_at >= ?',
+                             (self.namespace, key, self._min_created_at()))
+        return len(rows) > 0
+
+    def __setitem__(self, key: str, value) -> None:
+        blob = zlib.compress(json.dumps(value).encode('utf-8'), 1)
+        self._execute('INSERT OR REPLACE INTO cache (namespace, key, value, size, created_at) VALUES (?, ?, ?, ?, ?)',
+                      (self.namespace, key, blob, len(blob), time.time()))
+
+    def update(self, items) -> None:
+        """Store the (key, value) items in a single transaction."""
+        now = time.time()
+        rows = []
+        for key, value in items:
+            blob = zlib.compress(json.dumps(value).encode('utf-8'), 1)
+            rows.append((self.namespace, key, blob, len(blob), now))
+        with self.lock:
+            connection = get_connection(self.path)
+            connection.execute('BEGIN')
+            try:
+                connection.executemany('INSERT OR REPLACE INTO cache (namespace, key, value, size, created_at) VALUES (?, ?, ?, ?, ?)', rows)
+            except Exception:
+                connection.execute('ROLLBACK')
+                raise
+            connection.execute('COMMIT')
+
+    def __len__(self) -> int:
+        return self.stats()['nb_entries']
+
+    def clear(self) -> None:
+        self._execute('DELETE FROM cache WHERE namespace = ?', (self.namespace,))
+
+    def stats(self) -> dict:
+        rows = self._execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM cache WHERE namespace = ?',
+                             (self.namespace,))
+        return {'namespace': self.namespace, 'nb_entries': rows[0][0], 'size': rows[0][1]}
+
+    def evict(self, max_size: int = CACHE_MAX_SIZE) -> int:
+        """Delete expired entries, then the oldest ones while the namespace is bigger than max_size bytes."""
+        nb_deleted = 0
+        with self.lock:
+            connection = get_connection(self.path)
+            if self.max_age:
+                nb_deleted += connection.execute('DELETE FROM cache WHERE namespace = ? AND created_at < ?',
+                                                 (self.namespace, self._min_created_at())).rowcount
+            if max_size:
+                rows = connection.execute('SELECT key, size FROM cache WHERE namespace = ? ORDER BY created_at DESC',
+                                          (self.namespace,)).fetchall()
+                total_size, to_delete = 0, []
+                for key, size in rows:
+                    total_size += size
+                    if total_size > max_size:
+                        to_delete.append((self.namespace, key))
+                connection.executemany('DELETE FROM cache WHERE namespace = ? AND key = ?', to_delete)
+                nb_deleted += len(to_delete)
+        if nb_deleted:
+            logger.debug(f'{nb_deleted} entries evicted from cache {self.namespace}')
+        return nb_deleted
@@ -24,6 +24,13 @@ def get_client():
         client = Elasticsearch(ES_URL, http_auth=(ES_LOGIN_FRESQ_BACK, ES_PASSWORD_FRESQ_BACK))
     return client
 
+def close_client():
+    # a new client is created on the next get_client
+    global client
+    if client is not None:
+        client.transport.close()
+        client = None
+
 def get_filters() -> dict:
     return {
         'french_elision': {
@@ -14,13 +14,13 @@ from project.server.main.utils_swift import upload_object, download_object
 logger = get_logger(__name__)
 
 def clean_etapes(data):
-    ans = []
+    # records are cleaned one by one, as they are read
     for d in data:
         if 'formation_details' not in d:
-            ans.append(d)
+            yield d
             continue
         if 'etapes_details' not in d['formation_details']:
-            ans.append(d)
+            yield d
             continue
         for ix_etape, e in enumerate(d['formation_details']['etapes_details']):
             if 'references' in e:
@@ -38,8 +38,7 @@ def clean_etapes(data):
                         existing_info = new_info[f]
                     e[f] = existing_info
                 del e['references']
-        ans.append(d)
-    return ans
+        yield d
 
 def get_list_data(my_dict, my_key):
     ans = []
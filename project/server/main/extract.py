@@ -1,209 +1,499 @@
+import gzip
+import hashlib
+import itertools
 import json
 import math
 import os
-import requests
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from retry import retry
 import pandas as pd
 import datetime
 import time
 
-from project.server.main.utils import get_today, save_logs
+from project.server.main import http_client
+from project.server.main.cache import PersistentCache
+from project.server.main.utils import get_raw_data_filename, get_today, iter_fresq_raw, save_logs
 from project.server.main.logger import get_logger
-from project.server.main.utils_swift import upload_object, download_object
+from project.server.main.utils_swift import copy_object, upload_object
 
 logger = get_logger(__name__)
 
 FRESQ_AUTHENT_URL = os.getenv('FRESQ_AUTHENT_URL')
 FRESQ_LOGIN = os.getenv('FRESQ_LOGIN')
 FRESQ_PASSWORD = os.getenv('FRESQ_PASSWORD')
+# the token is refreshed that many seconds before it expires
+FRESQ_TOKEN_MARGIN = int(os.getenv('FRESQ_TOKEN_MARGIN', 30))
 
 FRESQ_BASE_URL = os.getenv('FRESQ_BASE_URL')
 URL_DIPLOMES = f'{FRESQ_BASE_URL}/api/referentiels/type_diplome'
 URL_SEARCH = f'{FRESQ_BASE_URL}/api/recherche'
+# optional referential of the establishments (same datas / data layout as the type_diplome one),
+# the complete list of uais used to split the queries over the search window
+FRESQ_ETABLISSEMENTS_URL = os.getenv('FRESQ_ETABLISSEMENTS_URL')
+FRESQ_DETAILS_URL = os.getenv('FRESQ_DETAILS_URL', 'https://fresq.enseignementsup.gouv.fr')
 
+# nb of formations harvested concurrently, and nb of parcours / etapes fetched concurrently
+FRESQ_NB_WORKERS = int(os.getenv('FRESQ_NB_WORKERS', 8))
+FRESQ_NB_DETAIL_WORKERS = int(os.getenv('FRESQ_NB_DETAIL_WORKERS', 16))
+
+# checkpointed extraction: listings and harvested records are streamed to compressed jsonl
+# shards in FRESQ_EXTRACT_DIR, a manifest keeps track of what is complete
+FRESQ_EXTRACT_DIR = os.getenv('FRESQ_EXTRACT_DIR', 'fresq_extract')
+FRESQ_EXTRACT_SHARD_SIZE = int(os.getenv('FRESQ_EXTRACT_SHARD_SIZE', 500))
+
+# the search only gives access to the first results of a query, and pages are fetched concurrently
+FRESQ_SEARCH_WINDOW = int(os.getenv('FRESQ_SEARCH_WINDOW', 9999))
+FRESQ_PAGE_SIZE = 100
+FRESQ_NB_PAGE_WORKERS = int(os.getenv('FRESQ_NB_PAGE_WORKERS', 4))
 
 API_SPECIFIC = {}
 API_SPECIFIC['BUT'] = 'diplome_but'
 API_SPECIFIC['M'] = 'diplome_master'
 
-cache_etape, cache_formation, cache_parcours, cache_etape_list = {}, {}, {}, {}
+# persisted on disk, so that a restarted worker or a resumed run only fetches what is missing
+cache_etape, cache_formation, cache_parcours, cache_etape_list = PersistentCache('etape'), PersistentCache('formation'), PersistentCache('parcours'), PersistentCache('etape_list')
+# details of the previous dump for the incremental mode, rewritten by each run
+cache_previous_details = PersistentCache('previous_details', max_age=0)
+detail_executor = None
+# uais by code_diplome, see get_known_uais
+known_uais = None
 
-@retry(delay=60, tries=3, logger=logger)
-def get_headers():
-    r = requests.post(FRESQ_AUTHENT_URL, data={
+def get_detail_executor():
+    # parcours and etapes get their own pool, distinct from the formation one, so that
+    # a formation waiting for its details never starves the workers that fetch them
+    global detail_executor
+    if detail_executor is None:
+        detail_executor = ThreadPoolExecutor(max_workers=FRESQ_NB_DETAIL_WORKERS, thread_name_prefix='fresq-detail')
+    return detail_executor
+
+def shutdown_detail_executor():
+    global detail_executor
+    if detail_executor is not None:
+        detail_executor.shutdown(wait=True)
+        detail_executor = None
+
+@retry(delay=10, backoff=2, tries=3, logger=logger)
+def authenticate():
+    r = http_client.post(FRESQ_AUTHENT_URL, data={
         'grant_type': 'password',
         'scope': 'openid',
         'username': FRESQ_LOGIN,
         'password': FRESQ_PASSWORD}, auth=('client-fresq', ''))
     try:
         tokens = r.json()
-        key = tokens['access_token']
-    except:
-        logger.debug('error in get_headers')
-        logger.debug(r.text)
-        tokens = r.json()
-        key = tokens['access_token']
-    headers= {'Authorization': f'Bearer {key}'}
-    time.sleep(1)
-    return headers
+        if 'access_token' in tokens:
+            return tokens
+    except ValueError:
+        pass
+    logger.debug('error in authenticate')
+    logger.debug(r.text)
+    raise ValueError(f'no access_token in the FRESQ authentication answer ({r.status_code})')
 
-@retry(delay=300, tries=5, logger=logger)
-def get_code_diplomes():
+class TokenManager:
+    """Caches the FRESQ bearer token, shared by all the fetchers of the process.
+
+    The token is refreshed when it is about to expire (expires_in of the token response)
+    or when FRESQ rejected it with a 401.
+    """
+
+    def __init__(self, margin: int = FRESQ_TOKEN_MARGIN):
+        self.margin = margin
+        self.lock = threading.Lock()
+        self.token = None
+        self.expires_at = 0
+        self.nb_authentications = 0
+
+    def get_headers(self) -> dict:
+        with self.lock:
+            if self.token is None or time.time() >= self.expires_at - self.margin:
+                tokens = authenticate()
+                self.token = tokens['access_token']
+                self.expires_at = time.time() + int(tokens.get('expires_in', 300))
+                self.nb_authentications += 1
+                logger.debug(f'new FRESQ token, valid for {tokens.get("expires_in")}s ({self.nb_authentications} authentications so far)')
+            return {'Authorization': f'Bearer {self.token}'}
+
+    def invalidate(self, headers: dict) -> None:
+        with self.lock:
+            # another fetcher may already have refreshed the rejected token
+            if headers.get('Authorization') == f'Bearer {self.token}':
+                self.token = None
+
+token_manager = TokenManager()
+
+def get_headers():
+    return token_manager.get_headers()
+
+def fresq_request(method, url, **kwargs):
     current_headers = get_headers()
-    type_diplomes = requests.get(URL_DIPLOMES, headers=current_headers).json()['datas']
+    r = http_client.request(method, url, headers=current_headers, **kwargs)
+    if r.status_code == 401:
+        logger.debug(f'401 on {url}, refreshing token')
+        token_manager.invalidate(current_headers)
+        r = http_client.request(method, url, headers=get_headers(), **kwargs)
+    return r
+
+@retry(delay=10, backoff=2, tries=3, logger=logger)
+def get_code_diplomes():
+    type_diplomes = fresq_request('GET', URL_DIPLOMES).json()['datas']
     code_diplomes = [t['data']['code'] for t in type_diplomes]
     return code_diplomes
 
-def get_params(code_diplome, pageNumber):
-    return {'uais': [],
+def get_params(code_diplome, pageNumber, uais=None, sortDirection='ASC'):
+    return {'uais': uais or [],
      'codesTypeDiplome': [code_diplome],
      'term': '',
      'pageNumber': pageNumber,
-     'pageSize': 100,
+     'pageSize': FRESQ_PAGE_SIZE,
      'sortProperty': 'nom_etablissement_sort',
-     'sortDirection': 'ASC',
+     'sortDirection': sortDirection,
      'searchInAttachments': False}
 
-@retry(delay=300, tries=5, logger=logger)
-def get_data(code_diplome):
-    logger.debug(f'getting data from FRESQ for code_diplome {code_diplome}')
-    data = []
-    params = get_params(code_diplome, 0)
-    current_headers = get_headers()
-    r = requests.post(URL_SEARCH, headers=current_headers, json=params).json()
-    time.sleep(1)
+@retry(delay=10, backoff=2, tries=3, logger=logger)
+def get_search_page(params):
+    return fresq_request('POST', URL_SEARCH, json=params).json()
+
+def search_pages(code_diplome, uais=None, sortDirection='ASC', nb_workers=1):
+    r = get_search_page(get_params(code_diplome, 0, uais, sortDirection))
     nb_pages = r['totalPages']
-    logger.debug(f'nb_pages = {nb_pages}')
+    # None when the api does not give the exact count, only the nb of pages is known then
+    nb_elements = r.get('totalElements')
+    # pages beyond the search window cannot be retrieved
+    nb_window_pages = math.ceil(FRESQ_SEARCH_WINDOW / FRESQ_PAGE_SIZE)
+    if nb_elements is None and nb_pages > nb_window_pages:
+        logger.debug(f'data_quality;fresq;no_total_elements;{code_diplome};{uais};{nb_pages} pages, only {nb_window_pages} retrieved')
+    nb_pages = min(nb_pages, nb_window_pages)
     data = r['content']
-    for p in range(1, nb_pages):
-        print(p, end=',')
-        params = get_params(code_diplome, p)
-        r = requests.post(URL_SEARCH, headers=current_headers, json=params).json()
-        #print(len(r['content']))
-        data += r['content']
-        time.sleep(1)
+    with ThreadPoolExecutor(max_workers=nb_workers, thread_name_prefix='fresq-page') as executor:
+        pages = executor.map(lambda p: get_search_page(get_params(code_diplome, p, uais, sortDirection)), range(1, nb_pages))
+        for page in pages:
+            data += page['content']
+    return nb_elements, data
+
+def dedup_records(data):
+    ans, known_ids = [], set()
+    for d in data:
+        if d['recordId'] not in known_ids:
+            known_ids.add(d['recordId'])
+            ans.append(d)
+    return ans
+
+@retry(delay=10, backoff=2, tries=3, logger=logger)
+def get_referential_uais():
+    if not FRESQ_ETABLISSEMENTS_URL:
+        return []
+    etablissements = fresq_request('GET', FRESQ_ETABLISSEMENTS_URL).json()['datas']
+    return [e['data'].get('uai') or e['data'].get('uai_etablissement') for e in etablissements]
+
+def get_known_uais(raw_data_suffix='latest'):
+    """uais to split the oversized queries with, by code_diplome: the establishments referential
+    and the uais of the previous dump. Loaded on the first oversized query of a run only."""
+    global known_uais
+    if known_uais is not None:
+        return known_uais
+    referential_uais = get_referential_uais()
+    logger.debug(f'{len(referential_uais)} uais in the establishments referential')
+    ans = {'all': referential_uais}
+    # only the uais are kept from the streamed dump
+    previous_uais = {}
+    try:
+        for d in iter_fresq_raw(raw_data_suffix):
+            previous_uais.setdefault(d['data'].get('code_type_diplome'), {})[d['data'].get('uai_etablissement')] = None
+    except Exception as e:
+        logger.debug(f'previous raw data {get_raw_data_filename(raw_data_suffix)} unavailable ({e})')
+    for code_diplome, uais in previous_uais.items():
+        ans[code_diplome] = [uai for uai in uais if isinstance(uai, str)]
+    known_uais = ans
+    return known_uais
+
+def search_partition(code_diplome, uais=None, nb_workers=1, retry_mismatch=True):
+    # over the search window, the results are also read from the other end: with the ascending
+    # window, that covers up to twice the window
+    nb_elements, data = search_pages(code_diplome, uais, nb_workers=nb_workers)
+    if nb_elements is not None and nb_elements > FRESQ_SEARCH_WINDOW:
+        _, data_desc = search_pages(code_diplome, uais, sortDirection='DESC', nb_workers=nb_workers)
+        data += data_desc
+    data = dedup_records(data)
+    # a record added or removed during the harvest: the partition is read again, once
+    if retry_mismatch and nb_elements is not None and len(data) != nb_elements and nb_elements <= 2 * FRESQ_SEARCH_WINDOW:
+        logger.debug(f'{len(data)} elements retrieved for code {code_diplome} and uais {uais} instead of {nb_elements}, retrying')
+        return search_partition(code_diplome, uais, nb_workers, retry_mismatch=False)
+    return nb_elements, data
+
+def get_data(code_diplome):
+    logger.debug(f'getting data from FRESQ for code_diplome {code_diplome}')
+    nb_elements, data = search_partition(code_diplome, nb_workers=FRESQ_NB_PAGE_WORKERS)
+    logger.debug(f'nb_elements = {nb_elements}')
+    if nb_elements is None:
+        # no exact count to check against, nor to decide on a split
+        logger.debug(f'{len(data)} elements retrieved for code {code_diplome}')
+        return data
+    if len(data) < nb_elements:
+        # too many results for the search window: the query is split by establishment, the uais
+        # coming from the referential, the previous dump and the records already retrieved
+        uais_by_code = get_known_uais()
+        uais = [d['data'].get('uai_etablissement') for d in data] + uais_by_code['all'] + uais_by_code.get(code_diplome, [])
+        uais = list(dict.fromkeys(uai for uai in uais if isinstance(uai, str) and uai))
+        logger.debug(f'{nb_elements} elements for code {code_diplome}, query split into {len(uais)} uais')
+        with ThreadPoolExecutor(max_workers=FRESQ_NB_PAGE_WORKERS, thread_name_prefix='fresq-partition') as executor:
+            for uai, (nb_elements_uai, data_uai) in zip(uais, executor.map(lambda uai: search_partition(code_diplome, uais=[uai]), uais)):
+                if nb_elements_uai is not None and len(data_uai) < nb_elements_uai:
+                    logger.debug(f'data_quality;fresq;truncated_uai;{code_diplome};{uai};{nb_elements_uai};{len(data_uai)}')
+                data += data_uai
+        data = dedup_records(data)
     logger.debug(f'{len(data)} elements retrieved for code {code_diplome}')
-    assert(len(data) < 9999)
+    if len(data) != nb_elements:
+        logger.debug(f'data_quality;fresq;nb_elements_mismatch;{code_diplome};{nb_elements};{len(data)};{len(data) - nb_elements}')
     return data
 
-@retry(delay=300, tries=5, logger=logger)
+@retry(delay=10, backoff=2, tries=3, logger=logger)
 def get_formation(technical_id, code_diplome):
     global cache_formation
     cache_key = f'{code_diplome}_{technical_id}'
-    if cache_key in cache_formation:
+    cached = cache_formation.get(cache_key)
+    if cached is not None:
         logger.debug(f'using cache formation for {cache_key}')
-        return cache_formation[cache_key]
+        return cached
     api_specific = ''
     assert(code_diplome in API_SPECIFIC)
     api_specific = API_SPECIFIC[code_diplome]
-    url = f'https://fresq.enseignementsup.gouv.fr/api/diplomes/{api_specific}/{technical_id}?stock=true'
+    url = f'{FRESQ_DETAILS_URL}/api/diplomes/{api_specific}/{technical_id}?stock=true'
     logger.debug(f'---- getting formation {url} --- ')
-    current_headers = get_headers()
-    r = requests.get(url, headers=current_headers).json()
+    r = fresq_request('GET', url).json()
     formation = r['data']
     parcours = formation.get('parcours_diplomants', [])
-    parcours_full = []
+    executor = get_detail_executor()
+    parcours_futures, etapes_futures = [], []
     # pour les parcours, malheureusement, un appel par parcours pour avoir le code sise
     if isinstance(parcours, list):
-        for p in parcours:
-            p_complet = get_parcours(p, code_diplome, current_headers)
-            parcours_full.append(p_complet)
-    formation['parcours_diplomants_full'] = parcours_full
-    logger.debug(f'{len(parcours_full)} parcours have been retrieved')
+        parcours_futures = [executor.submit(get_parcours, p, code_diplome) for p in parcours]
     etapes = formation.get('etapes')
-    etapes_full = []
     if isinstance(etapes, list) and len(etapes)>0:
         #formation['etapes_details'] = get_etapes_list(technical_id, code_diplome)
-        for e in etapes:
-            e_complet = get_etape(e, code_diplome, current_headers)
-            etapes_full.append(e_complet)
+        etapes_futures = [executor.submit(get_etape, e, code_diplome) for e in etapes]
+    # results are collected in submission order, so the output is the same as a sequential harvest
+    parcours_full = [f.result() for f in parcours_futures]
+    formation['parcours_diplomants_full'] = parcours_full
+    logger.debug(f'{len(parcours_full)} parcours have been retrieved')
+    etapes_full = [f.result() for f in etapes_futures]
     formation['etapes_details'] = etapes_full
     logger.debug(f'{len(etapes_full)} etapes have been retrieved')
     cache_formation[cache_key] = formation
     return formation
 
-@retry(delay=300, tries=5, logger=logger)
-def get_parcours(parcours_id, code_diplome, current_headers):
+@retry(delay=10, backoff=2, tries=3, logger=logger)
+def get_parcours(parcours_id, code_diplome):
     global cache_parcours
     cache_key = f'{code_diplome}_{parcours_id}'
-    if cache_key in cache_parcours:
+    cached = cache_parcours.get(cache_key)
+    if cached is not None:
         logger.debug(f'using cache parcours for {cache_key}')
-        return cache_parcours[cache_key]
-    url = f'https://fresq.enseignementsup.gouv.fr/api/parcours-diplomants/{parcours_id}'
-    #current_headers = get_headers()
-    #time.sleep(1)
-    r = requests.get(url, headers=current_headers).json()
+        return cached
+    url = f'{FRESQ_DETAILS_URL}/api/parcours-diplomants/{parcours_id}'
+    r = fresq_request('GET', url).json()
     ans = r['data']
     cache_parcours[cache_key] = ans
     return ans
 
-@retry(delay=300, tries=5, logger=logger)
-def get_etape(etape_id, code_diplome, current_headers):
+@retry(delay=10, backoff=2, tries=3, logger=logger)
+def get_etape(etape_id, code_diplome):
     global cache_etape
     cache_key = f'{code_diplome}_{etape_id}'
-    if cache_key in cache_etape:
+    cached = cache_etape.get(cache_key)
+    if cached is not None:
         logger.debug(f'using cache etape for {cache_key}')
-        return cache_etape[cache_key]
-    url = f'https://fresq.enseignementsup.gouv.fr/api/etapes/{etape_id}'
-    #current_headers = get_headers()
-    #time.sleep(1)
-    r = requests.get(url, headers=current_headers).json()
+        return cached
+    url = f'{FRESQ_DETAILS_URL}/api/etapes/{etape_id}'
+    r = fresq_request('GET', url).json()
     ans = r['data']
-    url2 = f'https://fresq.enseignementsup.gouv.fr/api/etapes/{etape_id}/references'
-    r2 = requests.get(url2, headers=current_headers).json()
+    url2 = f'{FRESQ_DETAILS_URL}/api/etapes/{etape_id}/references'
+    r2 = fresq_request('GET', url2).json()
     ans['references'] = r2
     cache_etape[cache_key] = ans
     return ans
 
 # unused, we need all the details, etape by etape
-@retry(delay=300, tries=5, logger=logger)
+@retry(delay=10, backoff=2, tries=3, logger=logger)
 def get_etapes_list(technical_id, code_diplome):
     global cache_etape_list
     cache_key = f'{code_diplome}_{technical_id}'
-    if cache_key in cache_etape_list:
+    cached = cache_etape_list.get(cache_key)
+    if cached is not None:
         logger.debug(f'using cache etape list for {cache_key}')
-        return cache_etape_list[cache_key]
+        return cached
     api_specific = ''
     if code_diplome in API_SPECIFIC.keys():
         api_specific = API_SPECIFIC[code_diplome]
-    url = f'https://fresq.enseignementsup.gouv.fr/api/diplomes/{api_specific}/{technical_id}/etapes?pageSize=100'
-    current_headers = get_headers()
-    time.sleep(1)
-    r = requests.get(url, headers=current_headers).json()
+    url = f'{FRESQ_DETAILS_URL}/api/diplomes/{api_specific}/{technical_id}/etapes?pageSize=100'
+    r = fresq_request('GET', url).json()
     ans = [e['data'] for e in r]
     cache_etape_list[cache_key] = ans
     return ans
 
-def get_full_data():
-    full_data = []
-    code_diplomes = get_code_diplomes()
-    for c in code_diplomes:
-        new_data = get_data(c)
-        full_data += new_data
-    logger.debug(f'{len(full_data)} elements retrieved for all codes')
-    for idx, d in enumerate(full_data):
-        code_diplome = d['data']['code_type_diplome']
-        if idx % 250 == 0:
-            logger.debug(f'{idx} / {len(full_data)} completed')
-        if code_diplome in API_SPECIFIC:
-            d['data']['formation_details'] = get_formation(d['recordId'], code_diplome)
-    return full_data
+def get_record_fingerprint(record):
+    # the whole listing record (recordId, versions, dates ...) minus the details we add
+    listing = dict(record)
+    listing['data'] = {k: v for k, v in record.get('data', {}).items() if k != 'formation_details'}
+    return hashlib.sha1(json.dumps(listing, sort_keys=True).encode('utf-8')).hexdigest()
+
+def get_previous_details(raw_data_suffix='latest'):
+    """Fingerprint and details of the formations of the previous dump, by recordId.
+
+    The dump is streamed into cache_previous_details, on disk, only one record at a time is in memory.
+    """
+    cache_previous_details.clear()
+    nb_details, batch = 0, []
+    try:
+        for d in iter_fresq_raw(raw_data_suffix):
+            if 'formation_details' in d.get('data', {}):
+                batch.append((d['recordId'], (get_record_fingerprint(d), d['data']['formation_details'])))
+                nb_details += 1
+            if len(batch) >= 1000:
+                cache_previous_details.update(batch)
+                batch = []
+        cache_previous_details.update(batch)
+    except Exception as e:
+        logger.debug(f'previous raw data {get_raw_data_filename(raw_data_suffix)} unavailable ({e}), full extraction')
+        cache_previous_details.clear()
+        return {}
+    logger.debug(f'{nb_details} formations details found in previous raw data {get_raw_data_filename(raw_data_suffix)}')
+    return cache_previous_details
+
+def write_jsonl_gz(data, filename):
+    # written under a temporary name, so that a file only exists once complete
+    with gzip.open(f'{filename}.tmp', 'wt', compresslevel=1) as f:
+        for d in data:
+            f.write(json.dumps(d))
+            f.write('\n')
+    os.replace(f'{filename}.tmp', filename)
+
+def read_jsonl_gz(filename):
+    with gzip.open(filename, 'rt') as f:
+        for line in f:
+            yield json.loads(line)
+
+def get_manifest_filename():
+    return os.path.join(FRESQ_EXTRACT_DIR, 'manifest.json')
+
+def get_listing_filename(code_diplome):
+    return os.path.join(FRESQ_EXTRACT_DIR, f'listing_{code_diplome}.jsonl.gz')
+
+def get_shard_filename(shard_idx):
+    return os.path.join(FRESQ_EXTRACT_DIR, f'shard_{shard_idx:05d}.jsonl.gz')
+
+def save_manifest(manifest):
+    manifest_filename = get_manifest_filename()
+    json.dump(manifest, open(f'{manifest_filename}.tmp', 'w'))
+    os.replace(f'{manifest_filename}.tmp', manifest_filename)
+
+def load_manifest(resume=False):
+    manifest_filename = get_manifest_filename()
+    if resume and os.path.exists(manifest_filename):
+        manifest = json.load(open(manifest_filename, 'r'))
+        logger.debug(f"resuming extraction {manifest['suffix']}: {len(manifest['listings'])} listings and {len(manifest['shards'])} shards already completed")
+        return manifest
+    shutil.rmtree(FRESQ_EXTRACT_DIR, ignore_errors=True)
+    os.makedirs(FRESQ_EXTRACT_DIR)
+    manifest = {'suffix': get_today(), 'shard_size': FRESQ_EXTRACT_SHARD_SIZE, 'code_diplomes': None,
+                'listings': [], 'shards': [], 'nb_records': None}
+    save_manifest(manifest)
+    return manifest
+
+def iter_listing(manifest):
+    for c in manifest['code_diplomes']:
+        yield from read_jsonl_gz(get_listing_filename(c))
+
+def get_formations_details(data, previous_details, nb_workers):
+    with_details = []
+    for d in data:
+        if d['data']['code_type_diplome'] not in API_SPECIFIC:
+            continue
+        previous = previous_details.get(d['recordId'])
+        # unchanged record in the listing, the details of the previous dump are reused
+        if previous and previous[0] == get_record_fingerprint(d):
+            d['data']['formation_details'] = previous[1]
+        else:
+            with_details.append(d)
+    logger.debug(f'{len(with_details)} formations details to retrieve with {nb_workers} workers')
+    with ThreadPoolExecutor(max_workers=nb_workers, thread_name_prefix='fresq-formation') as executor:
+        formations = executor.map(lambda d: get_formation(d['recordId'], d['data']['code_type_diplome']), with_details)
+        for d, formation in zip(with_details, formations):
+            d['data']['formation_details'] = formation
+    return data
+
+def extract_to_shards(nb_workers=None, incremental=False, resume=False):
+    if nb_workers is None:
+        nb_workers = FRESQ_NB_WORKERS
+    manifest = load_manifest(resume)
+    for cache in [cache_formation, cache_parcours, cache_etape]:
+        cache.evict()
+        logger.debug(f'cache {cache.stats()}')
+    if manifest['code_diplomes'] is None:
+        manifest['code_diplomes'] = get_code_diplomes()
+        save_manifest(manifest)
+    # the uais of the previous dump are read again for a new run
+    global known_uais
+    known_uais = None
+    for c in manifest['code_diplomes']:
+        if c in manifest['listings']:
+            continue
+        write_jsonl_gz(get_data(c), get_listing_filename(c))
+        manifest['listings'].append(c)
+        save_manifest(manifest)
+    previous_details = get_previous_details() if incremental else {}
+    nb_records = 0
+    listing = iter_listing(manifest)
+    for shard_idx in itertools.count():
+        data = list(itertools.islice(listing, manifest['shard_size']))
+        if not data:
+            break
+        nb_records += len(data)
+        if shard_idx in manifest['shards']:
+            continue
+        write_jsonl_gz(get_formations_details(data, previous_details, nb_workers), get_shard_filename(shard_idx))
+        manifest['shards'].append(shard_idx)
+        save_manifest(manifest)
+        logger.debug(f'shard {shard_idx} completed, {nb_records} records extracted')
+    manifest['nb_records'] = nb_records
+    save_manifest(manifest)
+    logger.debug(f'{nb_records} elements retrieved for all codes')
+    for cache in [cache_formation, cache_parcours, cache_etape]:
+        logger.debug(f'cache {cache.stats()}')
+    return manifest
+
+def iter_extracted_data(manifest):
+    for shard_idx in sorted(manifest['shards']):
+        yield from read_jsonl_gz(get_shard_filename(shard_idx))
+
+def get_full_data(nb_workers=None, incremental=False, resume=False):
+    manifest = extract_to_shards(nb_workers=nb_workers, incremental=incremental, resume=resume)
+    return list(iter_extracted_data(manifest))
 
 
 def save_data(data, suffix):
-    current_file = f'fresq_raw_{suffix}.json'
-    os.system(f'rm -rf {current_file}')
-    json.dump(data, open(current_file, 'w'))
-    os.system(f'rm -rf {current_file}.gz')
-    os.system(f'gzip {current_file}')
-    upload_object('fresq', f'{current_file}.gz', f'{current_file}.gz')
-    os.system(f'rm -rf {current_file}.gz')
-
-def extract_from_fresq():
+    # data can be any iterable, it is streamed into the gzipped json array
+    current_file = get_raw_data_filename(suffix)
+    with gzip.open(current_file, 'wt', compresslevel=6) as f:
+        f.write('[')
+        for idx, d in enumerate(data):
+            if idx > 0:
+                f.write(', ')
+            f.write(json.dumps(d))
+        f.write(']')
+    upload_object('fresq', current_file, current_file)
+    os.remove(current_file)
+    return current_file
+
+def extract_from_fresq(incremental=False, resume=False):
     logger.debug('>>>>>>>>>> EXTRACT >>>>>>>>>>')
-    full_data = get_full_data()
-    current_date = get_today()
-    save_data(full_data, current_date)
-    save_data(full_data, 'latest')
+    manifest = extract_to_shards(incremental=incremental, resume=resume)
+    current_date = manifest['suffix']
+    raw_data_filename = save_data(iter_extracted_data(manifest), current_date)
+    # latest is a server-side copy of the dated snapshot, written and uploaded only once
+    copy_object('fresq', raw_data_filename, get_raw_data_filename('latest'))
+    shutil.rmtree(FRESQ_EXTRACT_DIR, ignore_errors=True)
+    http_client.log_stats()
     save_logs()
     return current_date
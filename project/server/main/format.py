@@ -1,16 +1,23 @@
 import json
+import multiprocessing
 import os
 import re
-from typing import Any, Dict, List, Literal, Optional, Set, Tuple, TypedDict, Union
+import time
+from typing import Any, Dict, Iterator, List, Literal, Optional, Set, Tuple, TypedDict, Union
 
 from project.server.main.logger import get_logger
 from project.server.main.transform import get_transformed_data
-from project.server.main.utils import get_formatted_data_filename, save_logs, to_jsonl
+from project.server.main.utils import JsonlWriter, TeeWriter, get_formatted_data_filename, prepare_fork, save_logs
 from project.server.main.utils_swift import download_object, upload_object
 
 logger = get_logger(__name__)
 
 fresq_enriched = None
+# processes formatting the records, 1 to format them in the current process
+FORMAT_NB_WORKERS = int(os.getenv('FORMAT_NB_WORKERS', os.cpu_count() or 1))
+FORMAT_CHUNK_SIZE = int(os.getenv('FORMAT_CHUNK_SIZE', 500))
+# records being formatted, inherited by the forked workers
+records_to_format: List[Dict[str, Any]] = []
 
 LocationType = Literal['etablissement', 'site']
 
@@ -192,11 +199,118 @@ class FormationFormatted(TypedDict, total=False):
     hasSiseInfos: bool
 
 
+def parse_coordinates(coords: Optional[Union[str, List[float]]]) -> Optional[Tuple[float, float]]:
+    """Parse coordinates from various formats."""
+    if not coords:
+        return None
+
+    if isinstance(coords, (list, tuple)) and len(coords) == 2:
+        try:
+            return (float(coords[0]), float(coords[1]))
+        except (ValueError, TypeError):
+            return None
+
+    if isinstance(coords, str):
+        try:
+            parsed = json.loads(coords)
+            if isinstance(parsed, list) and len(parsed) == 2:
+                return (float(parsed[0]), float(parsed[1]))
+        except (json.JSONDecodeError, ValueError, TypeError):
+            pass
+
+        # Try regex match
+        match = re.match(r'\[?\s*(-?\d+\.?\d*)\s*,\s*(-?\d+\.?\d*)\s*\]?', coords)
+        if match:
+            return (float(match.group(1)), float(match.group(2)))
+
+    return None
+
+
+def parse_paysage_geoloc(geoloc: Optional[str]) -> Optional[Tuple[float, float]]:
+    """Parse paysage geoloc format: 'name###lat###lon'."""
+    if not geoloc or not isinstance(geoloc, str):
+        return None
+    parts = geoloc.split('###')
+    if len(parts) >= 3:
+        try:
+            lat = float(parts[1])
+            lon = float(parts[2])
+            return (lon, lat)  # Return as (lon, lat) for GeoJSON
+        except (ValueError, IndexError):
+            pass
+    return None
+
+
+class LocationEntry:
+    """Normalized location, shared by all the records it appears in."""
+    __slots__ = ('id', 'name', 'address', 'coords')
+
+    def __init__(self, id: str, name: str, address: Optional[Address], coords: Optional[Tuple[float, float]]):
+        self.id = id
+        self.name = name
+        self.address = address
+        self.coords = coords
+
+
+class LocationRegistry:
+    """Run-scoped memo of parsed coordinates and normalized locations.
+
+    The same sites and etablissements appear in thousands of formations: their coordinates
+    are parsed once and their LocationEntry built once per run. Entries are read-only, the
+    per-record types and address merges are kept by the LocationCollector.
+    """
+
+    def __init__(self):
+        self.coordinates: Dict[Any, Optional[Tuple[float, float]]] = {}
+        self.geolocs: Dict[str, Optional[Tuple[float, float]]] = {}
+        self.entries: Dict[Any, LocationEntry] = {}
+
+    def clear(self) -> None:
+        self.coordinates.clear()
+        self.geolocs.clear()
+        self.entries.clear()
+
+    def parse_coordinates(self, coords: Optional[Union[str, List[float]]]) -> Optional[Tuple[float, float]]:
+        key = tuple(coords) if isinstance(coords, list) else coords
+        try:
+            if key not in self.coordinates:
+                self.coordinates[key] = parse_coordinates(coords)
+            return self.coordinates[key]
+        except TypeError:
+            # unhashable
+            return parse_coordinates(coords)
+
+    def parse_paysage_geoloc(self, geoloc: Optional[str]) -> Optional[Tuple[float, float]]:
+        if not isinstance(geoloc, str):
+            return parse_paysage_geoloc(geoloc)
+        if geoloc not in self.geolocs:
+            self.geolocs[geoloc] = parse_paysage_geoloc(geoloc)
+        return self.geolocs[geoloc]
+
+    def get_entry(self, location_id: str, name: str, address: Optional[Address],
+                  coords: Optional[Tuple[float, float]]) -> LocationEntry:
+        try:
+            key = (location_id, name, tuple(address.items()) if address else None, coords)
+            entry = self.entries.get(key)
+        except TypeError:
+            # unhashable
+            return LocationEntry(location_id, name, address, coords)
+        if entry is None:
+            entry = LocationEntry(location_id, name, address, coords)
+            self.entries[key] = entry
+        return entry
+
+
+location_registry = LocationRegistry()
+
+
 class LocationCollector:
     """Collects and deduplicates locations with type merging."""
 
-    def __init__(self):
-        self.locations: Dict[str, Location] = {}
+    def __init__(self, registry: Optional[LocationRegistry] = None):
+        self.registry = registry or location_registry
+        # location id -> [shared entry, types, address] for this record
+        self.locations: Dict[str, list] = {}
 
     def _generate_id(self, id: Optional[str] = None,
                      coords: Optional[Tuple[float, float]] = None,
@@ -208,46 +322,6 @@ class LocationCollector:
             return f"{coords[0]:.6f},{coords[1]:.6f}"
         return name or 'unknown'
 
-    def _parse_coordinates(self, coords: Optional[Union[str, List[float]]]) -> Optional[Tuple[float, float]]:
-        """Parse coordinates from various formats."""
-        if not coords:
-            return None
-
-        if isinstance(coords, (list, tuple)) and len(coords) == 2:
-            try:
-                return (float(coords[0]), float(coords[1]))
-            except (ValueError, TypeError):
-                return None
-
-        if isinstance(coords, str):
-            try:
-                parsed = json.loads(coords)
-                if isinstance(parsed, list) and len(parsed) == 2:
-                    return (float(parsed[0]), float(parsed[1]))
-            except (json.JSONDecodeError, ValueError, TypeError):
-                pass
-
-            # Try regex match
-            match = re.match(r'\[?\s*(-?\d+\.?\d*)\s*,\s*(-?\d+\.?\d*)\s*\]?', coords)
-            if match:
-                return (float(match.group(1)), float(match.group(2)))
-
-        return None
-
-    def _parse_paysage_geoloc(self, geoloc: Optional[str]) -> Optional[Tuple[float, float]]:
-        """Parse paysage geoloc format: 'name###lat###lon'."""
-        if not geoloc or not isinstance(geoloc, str):
-            return None
-        parts = geoloc.split('###')
-        if len(parts) >= 3:
-            try:
-                lat = float(parts[1])
-                lon = float(parts[2])
-                return (lon, lat)  # Return as (lon, lat) for GeoJSON
-            except (ValueError, IndexError):
-                pass
-        return None
-
     def add(self, location_type: LocationType,
             id: Optional[str] = None,
             name: str = "",
@@ -258,39 +332,29 @@ class LocationCollector:
         if isinstance(geo_coords, tuple) and len(geo_coords) == 2:
             coords = geo_coords
         else:
-            coords = self._parse_coordinates(geo_coords)
+            coords = self.registry.parse_coordinates(geo_coords)
 
         location_id = self._generate_id(id, coords, name)
 
         existing = self.locations.get(location_id)
         if existing:
             # Merge types
-            existing_types = existing.get('types', [])
+            existing_types = existing[1]
             if location_type not in existing_types:
                 existing_types.append(location_type)
-                existing['types'] = existing_types
             # Merge address if more complete
-            existing_address = existing.get('address')
+            existing_address = existing[2]
             if address and (not existing_address or not existing_address.get('street')):
                 merged_address: Address = {}
                 if existing_address:
                     merged_address.update(existing_address)
                 merged_address.update(address)
-                existing['address'] = merged_address
+                existing[2] = merged_address
             return location_id
 
-        location: Location = {
-            'id': location_id,
-            'name': name,
-            'types': [location_type]
-        }
-
-        if address:
-            location['address'] = address
-        if coords and len(coords) == 2:
-            location['geo'] = {'type': 'Point', 'coordinates': list(coords)}
-
-        self.locations[location_id] = location
+        entry = self.registry.get_entry(location_id, name, address if address else None,
+                                        coords if coords and len(coords) == 2 else None)
+        self.locations[location_id] = [entry, [location_type], entry.address]
         return location_id
 
     def add_from_site_details(self, site: Dict[str, Any]) -> str:
@@ -323,7 +387,7 @@ class LocationCollector:
 
     def add_from_paysage(self, paysage_elt: Dict[str, Any]) -> str:
         """Add location from paysage element using its geoloc."""
-        geo_coords = self._parse_paysage_geoloc(paysage_elt.get('geoloc'))
+        geo_coords = self.registry.parse_paysage_geoloc(paysage_elt.get('geoloc'))
 
         return self.add(
             'etablissement',
@@ -334,7 +398,19 @@ class LocationCollector:
 
     def get_all(self) -> List[Location]:
         """Get all collected locations."""
-        return list(self.locations.values())
+        locations: List[Location] = []
+        for entry, types, address in self.locations.values():
+            location: Location = {
+                'id': entry.id,
+                'name': entry.name,
+                'types': list(types)
+            }
+            if address:
+                location['address'] = dict(address)
+            if entry.coords:
+                location['geo'] = {'type': 'Point', 'coordinates': list(entry.coords)}
+            locations.append(location)
+        return locations
 
     def get_ids(self) -> List[str]:
         """Get all location IDs."""
@@ -746,82 +822,98 @@ def format_record(data: Dict[str, Any]) -> FormationFormatted:
 
     return formation_with_search_field
 
+class OrderedValues:
+    """Insertion-ordered set of values, unhashable values are compared one by one."""
+    __slots__ = ('values', 'seen')
+
+    def __init__(self) -> None:
+        self.values: List[Any] = []
+        self.seen: Set[Any] = set()
+
+    def add(self, value: Any) -> None:
+        try:
+            if value in self.seen:
+                return
+            self.seen.add(value)
+        except TypeError:
+            if value in self.values:
+                return
+        self.values.append(value)
+
+    def extend(self, values: List[Any]) -> None:
+        for value in values:
+            self.add(value)
+
+
+def collect_search_values(elts: Any, fields: List[str]) -> Dict[str, OrderedValues]:
+    collected: Dict[str, OrderedValues] = {}
+    if isinstance(elts, list):
+        for e in elts:
+            for f in fields:
+                if f not in collected:
+                    collected[f] = OrderedValues()
+                if f in e:
+                    collected[f].add(e[f])
+    return collected
+
+
 def enrich_with_search(formation):
-    search_elt = {}
+    # each search field keeps its values in first-seen order, so documents are identical from run to run
+    search_values: Dict[str, Dict[str, OrderedValues]] = {}
     # ROME
-    search_info = 'romeInfos'
-    search_elt[search_info] = {}
-    if isinstance(formation.get(search_info), list):
-        for e in formation.get(search_info):
-            for f in ['codeRome', 'idLevel1', 'level1', 'idLevel2', 'level2', 'level3', 'label', 'ogr', 'rncp']:
-                if f not in search_elt[search_info]:
-                    search_elt[search_info][f] = []
-                if f in e and e[f] not in search_elt[search_info][f]:
-                    search_elt[search_info][f].append(e[f])
+    search_values['romeInfos'] = collect_search_values(formation.get('romeInfos'),
+        ['codeRome', 'idLevel1', 'level1', 'idLevel2', 'level2', 'level3', 'label', 'ogr', 'rncp'])
     # RNCP
-    search_info = 'rncpInfos'
-    search_elt[search_info] = {}
-    if isinstance(formation.get(search_info), list):
-        for e in formation.get(search_info):
-            for f in ['rncp', 'typeEmploiAccessibles']:
-                if f not in search_elt[search_info]:
-                    search_elt[search_info][f] = []
-                if f in e and e[f] not in search_elt[search_info][f]:
-                    search_elt[search_info][f].append(e[f])
+    search_values['rncpInfos'] = collect_search_values(formation.get('rncpInfos'), ['rncp', 'typeEmploiAccessibles'])
     # etapes
     search_info = 'etapes'
-    search_elt[search_info] = {}
+    search_values[search_info] = {}
     if isinstance(formation.get(search_info), list):
+        current = search_values[search_info]
         for e in formation.get(search_info):
             for f in ['infe', 'label']:
-                if f not in search_elt[search_info]:
-                    search_elt[search_info][f] = []
-                if f in e and e[f] not in search_elt[search_info][f]:
-                    search_elt[search_info][f].append(e[f])
+                if f not in current:
+                    current[f] = OrderedValues()
+                if f in e:
+                    current[f].add(e[f])
             if 'pedagogicalInfo' in e and isinstance(e['pedagogicalInfo'], dict):
                 for k in ['keywords', 'keywordsDisciplines', 'keywordsJobs', 'keywordsSectors']:
                     if isinstance(e['pedagogicalInfo'].get(k), list):
                         current_field = f'pedagogicalInfo{k.capitalize()}'
-                        if current_field not in search_elt[search_info]:
-                            search_elt[search_info][current_field] = []
-                        search_elt[search_info][current_field] += e['pedagogicalInfo'].get(k)
-                        search_elt[search_info][current_field] = list(set(search_elt[search_info][current_field]))
+                        if current_field not in current:
+                            current[current_field] = OrderedValues()
+                        current[current_field].extend(e['pedagogicalInfo'].get(k))
             if 'recruitmentInfo' in e and isinstance(e['recruitmentInfo'], dict) and isinstance(e['recruitmentInfo'].get('expectations'), list):
                 current_field = f'recruitmentInfoExpectations'
-                if current_field not in search_elt[search_info]:
-                    search_elt[search_info][current_field] = []
-                search_elt[search_info][current_field] += e['recruitmentInfo'].get('expectations')
-                search_elt[search_info][current_field] = list(set(search_elt[search_info][current_field]))
+                if current_field not in current:
+                    current[current_field] = OrderedValues()
+                current[current_field].extend(e['recruitmentInfo'].get('expectations'))
     # parcours
-    search_info = 'parcours'
-    search_elt[search_info] = {}
-    if isinstance(formation.get(search_info), list):
-        for e in formation.get(search_info):
-            for f in ['infp', 'label']:
-                if f not in search_elt[search_info]:
-                    search_elt[search_info][f] = []
-                if f in e and e[f] not in search_elt[search_info][f]:
-                    search_elt[search_info][f].append(e[f])
+    search_values['parcours'] = collect_search_values(formation.get('parcours'), ['infp', 'label'])
     # etablissements
     search_info = 'etablissements'
-    search_elt[search_info] = {}
+    search_values[search_info] = {}
     if isinstance(formation.get(search_info), list):
+        current = search_values[search_info]
         for e in formation.get(search_info):
             for f in ['uai', 'name', 'shortName', 'sigle', 'paysageName', 'city']:
-                if f not in search_elt[search_info]:
-                    search_elt[search_info][f] = []
-                if f in e and e[f] not in search_elt[search_info][f]:
-                    search_elt[search_info][f].append(e[f])
+                if f not in current:
+                    current[f] = OrderedValues()
+                if f in e:
+                    current[f].add(e[f])
                 if f == 'paysageName':
-                    if 'paysageElt' in e and isinstance(e['paysageElt'].get('name'), str) and e['paysageElt'].get('name') not in search_elt[search_info]['paysageName']:
-                        search_elt[search_info]['paysageName'].append(e['paysageElt'].get('name'))
+                    if 'paysageElt' in e and isinstance(e['paysageElt'].get('name'), str):
+                        current['paysageName'].add(e['paysageElt'].get('name'))
                 if f == 'city':
-                    if 'address' in e and isinstance(e['address'].get('city'), str) and e['address'].get('city') not in search_elt[search_info]['city']:
-                        search_elt[search_info]['city'].append(e['address'].get('city'))
+                    if 'address' in e and isinstance(e['address'].get('city'), str):
+                        current['city'].add(e['address'].get('city'))
+    search_elt = {}
+    for search_info, fields in search_values.items():
+        search_elt[search_info] = {f: values.values for f, values in fields.items()}
     # global
     for search_info in ['inf', 'label', 'disciplinarySector' ]:
         search_elt[search_info] = formation.get(search_info)
-    
+
     formation['search'] = search_elt
     return formation
 
@@ -832,7 +924,63 @@ def enrich_with_search(formation):
 # ============================================================================
 
 
-def format_transformed_data(raw_data_suffix: str = 'latest', dry_run: bool = False, output_path: Optional[str] = None) -> List[FormationFormatted]:
+def format_range(bounds: Tuple[int, int]) -> Tuple[int, List[FormationFormatted], float]:
+    start = time.time()
+    formatted = [format_record(record) for record in records_to_format[bounds[0]:bounds[1]]]
+    return os.getpid(), formatted, time.time() - start
+
+
+def iter_formatted(records: List[Dict[str, Any]], nb_workers: Optional[int] = None):
+    """Formatted records, in the order of records, formatted by chunks on nb_workers processes."""
+    global records_to_format
+    nb_workers = nb_workers or FORMAT_NB_WORKERS
+    if nb_workers <= 1:
+        for idx, record in enumerate(records):
+            if (idx + 1) % 2000 == 0:
+                logger.debug(f'Processing record {idx + 1}/{len(records)}')
+            yield format_record(record)
+        return
+    # the forked workers read their chunk from records_to_format, only the results are sent back
+    records_to_format = records
+    prepare_fork()
+    chunks = [(k, min(k + FORMAT_CHUNK_SIZE, len(records))) for k in range(0, len(records), FORMAT_CHUNK_SIZE)]
+    workers_stats: Dict[int, List[float]] = {}
+    nb_done = 0
+    try:
+        with multiprocessing.get_context('fork').Pool(nb_workers) as pool:
+            for pid, formatted, delta in pool.imap(format_range, chunks):
+                workers_stats.setdefault(pid, [0, 0.0])
+                workers_stats[pid][0] += len(formatted)
+                workers_stats[pid][1] += delta
+                yield from formatted
+                nb_done += len(formatted)
+                logger.debug(f'Processing record {nb_done}/{len(records)}')
+    finally:
+        records_to_format = []
+    for pid, (nb_records, delta) in workers_stats.items():
+        logger.debug(f'format worker {pid}: {nb_records} records in {delta:.1f}s, {nb_records / max(delta, 1e-6):.0f} records/s')
+
+
+def format_transformed_data(raw_data_suffix: str = 'latest', dry_run: bool = False, output_path: Optional[str] = None,
+                            sinks: Optional[list] = None, iterate: bool = False) -> Union[int, Iterator[FormationFormatted]]:
+    """Format the transformed records and write them to the formatted file.
+
+    Each record is serialized once and written to the formatted file, to output_path (appended)
+    and to the extra sinks if any (see TeeWriter). Returns the number of records formatted,
+    or with iterate=True an iterator on the formatted records, which does the work as it is
+    consumed - the records are not kept in memory.
+    """
+    records = write_formatted_data(raw_data_suffix, dry_run, output_path, sinks)
+    if iterate:
+        return records
+    nb_formatted = 0
+    for _ in records:
+        nb_formatted += 1
+    return nb_formatted
+
+
+def write_formatted_data(raw_data_suffix: str, dry_run: bool, output_path: Optional[str],
+                         sinks: Optional[list]) -> Iterator[FormationFormatted]:
     logger.debug('>>>>>>>>>> TRANSFORM FORMAT >>>>>>>>>>')
     logger.debug(f'Starting FRESQ data formatting from {raw_data_suffix} (dry_run={dry_run})')
 
@@ -841,30 +989,25 @@ def format_transformed_data(raw_data_suffix: str = 'latest', dry_run: bool = Fal
         fresq_enriched = get_transformed_data(raw_data_suffix)
     if fresq_enriched is None:
         logger.error('Failed to load transformed data')
-        return []
+        return
 
     logger.debug(f'Loaded {len(fresq_enriched)} raw records')
     logger.debug('Formatting records...')
-    fresq_formatted: List[FormationFormatted] = []
-
-    for idx, record in enumerate(fresq_enriched):
-        if (idx + 1) % 2000 == 0:
-            logger.debug(f'Processing record {idx + 1}/{len(fresq_enriched)}')
+    location_registry.clear()
 
-        formatted = format_record(record)
-        fresq_formatted.append(formatted)
-
-    logger.debug(f'Formatted {len(fresq_formatted)} records')
-
-    # Save to file
+    # Save to file(s), in the original order, as the chunks are formatted
     formatted_data_filename = get_formatted_data_filename(raw_data_suffix)
-    os.system(f'rm -rf {formatted_data_filename}')
-    to_jsonl(fresq_formatted, formatted_data_filename)
-    logger.debug(f'Saved to {formatted_data_filename}')
+    writers = [JsonlWriter(formatted_data_filename)]
+    if output_path:
+        writers.append(JsonlWriter(output_path, 'a'))
+    with TeeWriter(writers + (sinks or [])) as writer:
+        for formatted in iter_formatted(fresq_enriched):
+            writer.write(formatted)
+            yield formatted
 
-    # Save to custom output path if provided
+    logger.debug(f'Formatted {writer.nb_written} records')
+    logger.debug(f'Saved to {formatted_data_filename}')
     if output_path:
-        to_jsonl(fresq_formatted, output_path)
         logger.debug(f'Saved to custom path: {output_path}')
 
     if not dry_run:
@@ -875,8 +1018,6 @@ def format_transformed_data(raw_data_suffix: str = 'latest', dry_run: bool = Fal
     else:
         logger.debug('Skipping upload (dry_run=True)')
 
-    return fresq_formatted
-
 
 def get_formatted_data(raw_data_suffix: str = 'latest') -> List[FormationFormatted]:
     """Get formatted data from storage."""
@@ -0,0 +1,216 @@
+import os
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from project.server.main.logger import get_logger
+
+logger = get_logger(__name__)
+
+# keep-alive connections kept per host, and (connect, read) timeouts in seconds
+HTTP_POOL_SIZE = int(os.getenv('HTTP_POOL_SIZE', 32))
+HTTP_CONNECT_TIMEOUT = float(os.getenv('HTTP_CONNECT_TIMEOUT', 10))
+HTTP_READ_TIMEOUT = float(os.getenv('HTTP_READ_TIMEOUT', 300))
+
+# requests per second allowed per host, HTTP_RATE_LIMITS overrides it for some hosts,
+# e.g. 'api.paysage.dataesr.ovh=10,fresq.enseignementsup.gouv.fr=20'. No documented quota
+# for FRESQ nor Paysage, so by default (0) hosts are not rate limited
+HTTP_RATE_LIMIT = float(os.getenv('HTTP_RATE_LIMIT', 0))
+HTTP_RATE_LIMITS = dict((k.split('=')[0], float(k.split('=')[1])) for k in os.getenv('HTTP_RATE_LIMITS', '').split(',') if '=' in k)
+
+# retries of a single request, with jittered exponential backoff
+HTTP_MAX_RETRIES = int(os.getenv('HTTP_MAX_RETRIES', 6))
+HTTP_BACKOFF_BASE = float(os.getenv('HTTP_BACKOFF_BASE', 1))
+HTTP_BACKOFF_MAX = float(os.getenv('HTTP_BACKOFF_MAX', 120))
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+THROTTLE_STATUSES = {429, 503}
+
+sessions, limiters, stats = {}, {}, {}
+lock = threading.Lock()
+# optional object with a record(method, url, kwargs, response) method, see standin.CassetteRecorder
+recorder = None
+
+
+class RateLimiter:
+    """Token bucket of an upstream host.
+
+    The rate is halved each time the host answers 429 or 503 (and the host is not called
+    before its Retry-After), then increases again step by step as requests succeed.
+    """
+
+    def __init__(self, rate: float, burst: float = None):
+        self.max_rate = rate
+        self.min_rate = rate / 64
+        self.rate = rate
+        self.burst = burst or max(1.0, rate)
+        self.tokens = self.burst
+        self.updated_at = time.monotonic()
+        self.blocked_until = 0.0
+        self.lock = threading.Lock()
+
+    def acquire(self) -> float:
+        """Wait for a token and return the time waited."""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+            # a negative balance is a reservation on the tokens to come
+            self.tokens -= 1
+            wait = max(self.blocked_until - now, -self.tokens / self.rate, 0)
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    def throttled(self, retry_after: float = None) -> None:
+        with self.lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+            if retry_after:
+                self.blocked_until = max(self.blocked_until, time.monotonic() + retry_after)
+
+    def succeeded(self) -> None:
+        with self.lock:
+            if self.rate < self.max_rate:
+                self.rate = min(self.max_rate, self.rate + self.max_rate / 50)
+
+
+def get_host(url: str) -> str:
+    return urlparse(url).netloc
+
+
+def get_session(host: str) -> requests.Session:
+    with lock:
+        if host not in sessions:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=HTTP_POOL_SIZE)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            sessions[host] = session
+        if host not in limiters:
+            rate = HTTP_RATE_LIMITS.get(host, HTTP_RATE_LIMIT)
+            limiters[host] = RateLimiter(rate) if rate > 0 else None
+            stats[host] = {'nb_requests': 0, 'nb_errors': 0, 'nb_retries': 0, 'nb_throttled': 0,
+                           'total_time': 0.0, 'max_time': 0.0, 'wait_time': 0.0}
+        return sessions[host]
+
+
+def close_sessions() -> None:
+    """Close the keep-alive sessions, new ones are opened on the next request."""
+    with lock:
+        for session in sessions.values():
+            session.close()
+        sessions.clear()
+
+
+def record(host: str, delta: float = 0, wait: float = 0, is_error: bool = False,
+           is_retry: bool = False, is_throttled: bool = False) -> None:
+    with lock:
+        host_stats = stats[host]
+        if delta:
+            host_stats['nb_requests'] += 1
+            host_stats['total_time'] += delta
+            host_stats['max_time'] = max(host_stats['max_time'], delta)
+        host_stats['wait_time'] += wait
+        host_stats['nb_errors'] += is_error
+        host_stats['nb_retries'] += is_retry
+        host_stats['nb_throttled'] += is_throttled
+
+
+def get_retry_after(response: requests.Response) -> float:
+    retry_after = response.headers.get('Retry-After')
+    if not retry_after:
+        return None
+    try:
+        return max(0.0, float(retry_after))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(retry_after).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def get_backoff(attempt: int) -> float:
+    return random.uniform(0.5, 1) * min(HTTP_BACKOFF_MAX, HTTP_BACKOFF_BASE * 2 ** attempt)
+
+
+def request(method: str, url: str, **kwargs) -> requests.Response:
+    """Send a request through the keep-alive session of the url's host.
+
+    The host rate limit is applied, and connection errors, timeouts and 429 / 5xx answers
+    are retried up to HTTP_MAX_RETRIES times. The last answer is returned as is.
+    """
+    host = get_host(url)
+    session = get_session(host)
+    limiter = limiters[host]
+    kwargs.setdefault('timeout', (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT))
+    for attempt in range(HTTP_MAX_RETRIES + 1):
+        is_last = attempt == HTTP_MAX_RETRIES
+        if limiter is not None:
+            record(host, wait=limiter.acquire())
+        start = time.time()
+        try:
+            response = session.request(method, url, **kwargs)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            record(host, time.time() - start, is_error=True)
+            if is_last:
+                raise
+            backoff = get_backoff(attempt)
+            logger.debug(f'{e.__class__.__name__} on {url}, retry in {backoff:.1f}s')
+            time.sleep(backoff)
+            record(host, wait=backoff, is_retry=True)
+            continue
+        is_error = response.status_code >= 400
+        record(host, time.time() - start, is_error=is_error)
+        if is_last or response.status_code not in RETRY_STATUSES:
+            if not is_error and limiter is not None:
+                limiter.succeeded()
+            if recorder is not None and not kwargs.get('stream'):
+                recorder.record(method, url, kwargs, response)
+            return response
+        retry_after = get_retry_after(response)
+        is_throttled = response.status_code in THROTTLE_STATUSES
+        if is_throttled and limiter is not None:
+            limiter.throttled(retry_after)
+        backoff = retry_after if retry_after is not None else get_backoff(attempt)
+        logger.debug(f'{response.status_code} on {url}, retry in {backoff:.1f}s')
+        response.close()
+        time.sleep(backoff)
+        record(host, wait=backoff, is_retry=True, is_throttled=is_throttled)
+
+
+def set_recorder(new_recorder) -> None:
+    global recorder
+    recorder = new_recorder
+
+
+def get(url: str, **kwargs) -> requests.Response:
+    return request('GET', url, **kwargs)
+
+
+def post(url: str, **kwargs) -> requests.Response:
+    return request('POST', url, **kwargs)
+
+
+def get_stats() -> dict:
+    with lock:
+        ans = {host: dict(host_stats) for host, host_stats in stats.items()}
+    for host in ans:
+        ans[host]['rate'] = limiters[host].rate if limiters[host] is not None else None
+    return ans
+
+
+def log_stats() -> None:
+    for host, host_stats in get_stats().items():
+        nb_requests = host_stats['nb_requests']
+        mean_time = host_stats['total_time'] / nb_requests if nb_requests else 0
+        rate = 'unlimited' if host_stats['rate'] is None else f"{host_stats['rate']:.1f}/s"
+        logger.debug(f"http {host}: {nb_requests} requests, {host_stats['nb_errors']} errors, "
+                     f"{host_stats['nb_retries']} retries ({host_stats['nb_throttled']} throttled), "
+                     f"mean {mean_time:.3f}s, max {host_stats['max_time']:.3f}s, "
+                     f"working {host_stats['total_time']:.1f}s vs waiting {host_stats['wait_time']:.1f}s, "
+                     f"current rate {rate}")
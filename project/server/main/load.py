@@ -1,12 +1,11 @@
-import json
-import math
 import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 
-import requests
-from retry import retry
+from elasticsearch import helpers
 
 from project.server.main.elastic import (
-    get_es_host,
+    get_client,
     get_mappings_etab,
     get_mappings_fresq,
     get_mappings_mentions,
@@ -26,6 +25,118 @@ from project.server.main.utils_swift import download_object, upload_object
 
 logger = get_logger(__name__)
 
+# bulk requests are cut at ES_BULK_CHUNK_SIZE documents or ES_BULK_MAX_BYTES bytes,
+# ES_BULK_NB_WORKERS of them in flight
+ES_BULK_CHUNK_SIZE = int(os.getenv('ES_BULK_CHUNK_SIZE', 1000))
+ES_BULK_MAX_BYTES = int(os.getenv('ES_BULK_MAX_BYTES', 10 * 1024 * 1024))
+ES_BULK_NB_WORKERS = int(os.getenv('ES_BULK_NB_WORKERS', 4))
+ES_BULK_REQUEST_TIMEOUT = int(os.getenv('ES_BULK_REQUEST_TIMEOUT', 120))
+# documents rejected with a 429 are retried, with exponential backoff
+ES_BULK_MAX_RETRIES = int(os.getenv('ES_BULK_MAX_RETRIES', 5))
+ES_BULK_INITIAL_BACKOFF = float(os.getenv('ES_BULK_INITIAL_BACKOFF', 2))
+ES_BULK_MAX_BACKOFF = float(os.getenv('ES_BULK_MAX_BACKOFF', 120))
+# documents allowed to fail before the load fails
+ES_BULK_MAX_ERRORS = int(os.getenv('ES_BULK_MAX_ERRORS', 0))
+
+
+class BulkLoadError(Exception):
+    pass
+
+
+def iter_jsonl_lines(filename):
+    """Lines of a jsonl file, sent as is as the _source of the documents."""
+    with open(filename, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                yield line
+
+
+def iter_chunks(actions, chunk_size):
+    chunk = []
+    for action in actions:
+        chunk.append(action)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def bulk_chunk(index_name, chunk):
+    """Index a chunk of documents and return the failed items, 429s retried."""
+    es = get_client()
+    errors = []
+    for _, item in helpers.streaming_bulk(es, chunk, chunk_size=ES_BULK_CHUNK_SIZE, max_chunk_bytes=ES_BULK_MAX_BYTES,
+                                          raise_on_error=False, raise_on_exception=False,
+                                          max_retries=ES_BULK_MAX_RETRIES, initial_backoff=ES_BULK_INITIAL_BACKOFF,
+                                          max_backoff=ES_BULK_MAX_BACKOFF, yield_ok=False,
+                                          index=index_name, request_timeout=ES_BULK_REQUEST_TIMEOUT):
+        errors.append(item)
+    return len(chunk) - len(errors), errors
+
+
+def get_error_key(item):
+    op_result = list(item.values())[0] if item else {}
+    error = op_result.get('error')
+    error_type = error.get('type') if isinstance(error, dict) else str(error)[:100]
+    return f"{op_result.get('status')};{error_type}"
+
+
+def bulk_load(index_name, actions, nb_workers=None):
+    """Index documents (dicts, or raw json strings) with parallel bulk requests.
+
+    Per-item failures are counted by status and error type, and a BulkLoadError is raised
+    when there are more than ES_BULK_MAX_ERRORS of them. Returns the number of documents indexed.
+    """
+    if nb_workers is None:
+        nb_workers = ES_BULK_NB_WORKERS
+    start = time.time()
+    nb_indexed, nb_errors, error_counts, first_errors = 0, 0, {}, []
+
+    def collect(futures):
+        nonlocal nb_indexed, nb_errors
+        for future in futures:
+            nb_chunk_indexed, errors = future.result()
+            nb_indexed += nb_chunk_indexed
+            nb_errors += len(errors)
+            for item in errors:
+                key = get_error_key(item)
+                error_counts[key] = error_counts.get(key, 0) + 1
+            first_errors.extend(errors[:3 - len(first_errors)])
+
+    with ThreadPoolExecutor(max_workers=nb_workers) as executor:
+        futures = set()
+        for chunk in iter_chunks(actions, ES_BULK_CHUNK_SIZE):
+            futures.add(executor.submit(bulk_chunk, index_name, chunk))
+            # a few chunks ahead of the workers, not the whole file
+            if len(futures) >= 2 * nb_workers:
+                done, futures = wait(futures, return_when=FIRST_COMPLETED)
+                collect(done)
+        collect(futures)
+
+    delta = time.time() - start
+    logger.debug(f'{nb_indexed} documents indexed in {index_name} in {delta:.1f}s ({nb_indexed / max(delta, 1e-6):.0f} docs/s), {nb_errors} errors')
+    for key, nb in error_counts.items():
+        logger.debug(f'data_quality;elastic;bulk_error;{index_name};{key};{nb}')
+    if first_errors:
+        logger.debug(f'first errors in {index_name}: {first_errors}')
+    if nb_errors > ES_BULK_MAX_ERRORS:
+        raise BulkLoadError(f'{nb_errors} documents not indexed in {index_name}')
+    return nb_indexed
+
+
+def load_file(filename, index_name):
+    bulk_load(index_name, iter_jsonl_lines(filename))
+    refresh_index(index_name)
+
+
+def index_file(filename, index_name, mappings):
+    """(Re)create the index and load the local jsonl file in it."""
+    reset_index(index=index_name, mappings=mappings)
+    load_file(filename, index_name)
+
+
 def load_metiers(raw_data_suffix, index_name='fresq-metiers'):
     logger.debug('>>>>>>>>>> LOAD METIERS >>>>>>>>>>')
     if index_name is None:
@@ -34,10 +145,7 @@ def load_metiers(raw_data_suffix, index_name='fresq-metiers'):
     download_object('fresq', current_file, current_file)
     mappings_metiers = get_mappings_metiers()
     reset_index(index=index_name, mappings = mappings_metiers)
-    es_host = get_es_host()
-    elasticimport = f"elasticdump --input={current_file} --output={es_host}{index_name} --type=data --limit 1000 --noRefresh " + "--transform='doc._source=Object.assign({},doc)'"
-    os.system(elasticimport)
-    refresh_index(index_name)
+    load_file(current_file, index_name)
 
 def load_etabs(raw_data_suffix, index_name='fresq-etablissements-2'):
     logger.debug('>>>>>>>>>> LOAD ETABS >>>>>>>>>>')
@@ -45,12 +153,7 @@ def load_etabs(raw_data_suffix, index_name='fresq-etablissements-2'):
         index_name = f'fresq-etablissements-{raw_data_suffix}'
     etab_filename = get_etab_filename(raw_data_suffix)
     download_object('fresq', etab_filename, etab_filename)
-    mappings_etab = get_mappings_etab()
-    reset_index(index=index_name, mappings = mappings_etab)
-    es_host = get_es_host()
-    elasticimport = f"elasticdump --input={etab_filename} --output={es_host}{index_name} --type=data --limit 1000 --noRefresh " + "--transform='doc._source=Object.assign({},doc)'"
-    os.system(elasticimport)
-    refresh_index(index_name)
+    index_file(etab_filename, index_name, get_mappings_etab())
 
 def load_mentions(raw_data_suffix, index_name='fresq-mentions'):
     logger.debug('>>>>>>>>>> LOAD MENTIONS >>>>>>>>>>')
@@ -58,12 +161,7 @@ def load_mentions(raw_data_suffix, index_name='fresq-mentions'):
         index_name = f'fresq-mentions-{raw_data_suffix}'
     mentions_filename = get_mentions_filename(raw_data_suffix)
     download_object('fresq', mentions_filename, mentions_filename)
-    mappings_mentions = get_mappings_mentions()
-    reset_index(index=index_name, mappings = mappings_mentions)
-    es_host = get_es_host()
-    elasticimport = f"elasticdump --input={mentions_filename} --output={es_host}{index_name} --type=data --limit 1000 --noRefresh " + "--transform='doc._source=Object.assign({},doc)'"
-    os.system(elasticimport)
-    refresh_index(index_name)
+    index_file(mentions_filename, index_name, get_mappings_mentions())
 
 def load_fresq(raw_data_suffix, index_name):
     if index_name is None:
@@ -81,10 +179,10 @@ def load_fresq(raw_data_suffix, index_name):
 
     mappings_fresq = get_mappings_fresq()
     reset_index(index=index_name, mappings = mappings_fresq)
-    es_host = get_es_host()
-    #elasticimport = f"elasticdump --input={transformed_data_filename} --output={es_host}{index_name} --type=data --limit 100 --noRefresh " + "--transform='doc._source=Object.assign({},doc)'"
-    elasticimport = f"elasticdump --input={formatted_data_filename} --output={es_host}{index_name} --type=data --limit 100 --noRefresh " + "--transform='doc._source=Object.assign({},doc)'"
-    os.system(elasticimport)
-    refresh_index(index_name)
+    load_file(formatted_data_filename, index_name)
     
     save_logs()
+
+def bulk_index(index_name, docs):
+    """Index a batch of documents, see bulk_load."""
+    return bulk_load(index_name, [{'_source': doc} for doc in docs])
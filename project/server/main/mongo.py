@@ -27,6 +27,14 @@ def get_client():
     return client
 
 
+def close_client() -> None:
+    """Close the client and its monitoring threads, a new one is created on the next get_client."""
+    global client
+    if client is not None:
+        client.close()
+        client = None
+
+
 def load_mongo(raw_data_suffix: str, index_name: Optional[str] = None) -> int:
     if index_name is None:
         index_name = f'fresq-{raw_data_suffix}'
@@ -42,16 +50,32 @@ def load_mongo(raw_data_suffix: str, index_name: Optional[str] = None) -> int:
         logger.warning(f'No data found in {formatted_data_filename}')
         return 0
 
+    reset_collection(index_name)
+    inserted_count = insert_documents(index_name, data)
+    add_collection_to_aliases(index_name)
+
+    logger.debug(f'Import complete: {inserted_count} documents inserted into {index_name}')
+    return inserted_count
+
+
+def reset_collection(index_name: str) -> None:
     db = get_client()[MONGO_DATABASE]
     if index_name in db.list_collection_names():
         logger.debug(f'Collection {index_name} already exists. Dropping...')
         db[index_name].drop()
         logger.debug(f'Collection {index_name} dropped')
 
+
+def insert_documents(index_name: str, data: List[dict]) -> int:
+    db = get_client()[MONGO_DATABASE]
     operations = [InsertOne(doc) for doc in data]
     result = db[index_name].bulk_write(operations, ordered=False)
+    return result.inserted_count
+
 
+def add_collection_to_aliases(index_name: str) -> None:
     # Add index to aliases list
+    db = get_client()[MONGO_DATABASE]
     db[ALIASES_COLLECTION].update_one(
         {'collection': 'programs'},
         {
@@ -61,9 +85,6 @@ def load_mongo(raw_data_suffix: str, index_name: Optional[str] = None) -> int:
         upsert=True
     )
 
-    logger.debug(f'Import complete: {result.inserted_count} documents inserted into {index_name}')
-    return result.inserted_count
-
 
 def update_mongo_alias(index_name: str) -> bool:
     db = get_client()[MONGO_DATABASE]
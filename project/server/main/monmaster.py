@@ -1,6 +1,7 @@
-import requests, json
+import json
 import pandas as pd
 import os
+from project.server.main import http_client
 from project.server.main.utils import get_today
 from project.server.main.utils_swift import upload_object, download_object
 
@@ -14,7 +15,7 @@ def get_monmaster():
     headers = {'Accept': 'application/json'}
     params = {'size': '10000'}
     MONMASTER_URL = os.getenv('MONMASTER_URL')
-    response = requests.post(MONMASTER_URL, json=params, headers=headers)
+    response = http_client.post(MONMASTER_URL, json=params, headers=headers)
     #data = response.json()['hits']['hits']
     data = response.json()['content']
     logger.debug(f'{len(data)} records harvested from mon master')
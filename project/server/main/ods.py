@@ -1,6 +1,8 @@
-import requests
 import pandas as pd
 import os
+from io import BytesIO
+
+from project.server.main import http_client
 from project.server.main.logger import get_logger
 
 logger = get_logger(__name__)
@@ -9,6 +11,9 @@ ODS_API_KEY = os.getenv('ODS_API_KEY')
 
 def get_ods_data(key):
     logger.debug(f'getting ods data {key}')
-    current_df = pd.read_csv(f'https://data.enseignementsup-recherche.gouv.fr/explore/dataset/{key}/download/?format=csv&apikey={ODS_API_KEY}', sep=';')
+    url = f'https://data.enseignementsup-recherche.gouv.fr/explore/dataset/{key}/download/?format=csv&apikey={ODS_API_KEY}'
+    r = http_client.get(url)
+    r.raise_for_status()
+    current_df = pd.read_csv(BytesIO(r.content), sep=';')
     return current_df
 
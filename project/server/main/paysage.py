@@ -1,16 +1,23 @@
-import requests
 from retry import retry
+import json
 import os
 import pickle
+import threading
 import pandas as pd
 import copy
-from project.server.main.utils import get_df_fresq_raw, get_etab_filename, to_jsonl, save_logs
+from concurrent.futures import ThreadPoolExecutor
+from project.server.main import http_client
+from project.server.main.cache import PersistentCache
+from project.server.main.utils import iter_fresq_raw, get_etab_filename, to_jsonl, save_logs
 from project.server.main.utils_swift import upload_object, download_object
 from project.server.main.logger import get_logger
 logger = get_logger(__name__)
 
 API_KEY = os.getenv('PAYSAGE_API_KEY')
 PAYSAGE_URL = os.getenv('PAYSAGE_URL')
+PAYSAGE_NB_WORKERS = int(os.getenv('PAYSAGE_NB_WORKERS', 8))
+# UAI resolutions are kept between runs, only new or expired UAIs are asked to the API
+PAYSAGE_CACHE_MAX_AGE = int(os.getenv('PAYSAGE_CACHE_MAX_AGE', 3 * 24 * 3600))
 
 headers = {
     'Content-Type': 'application/json',
@@ -18,6 +25,10 @@ headers = {
 }
 
 paysage_uai_map, final_uai_paysage_correspondance = {}, {}
+# structures by paysage id, shared by all the parents and successeurs lookups of a run
+paysage_structures = {}
+paysage_lock = threading.Lock()
+cache_paysage_uai = PersistentCache('paysage_uai', max_age=PAYSAGE_CACHE_MAX_AGE)
 
 def enrich_with_paysage(elt):
     global final_uai_paysage_correspondance
@@ -41,26 +52,26 @@ def enrich_with_paysage(elt):
 def get_etabs(raw_data_suffix):
     global paysage_uai_map
     global final_uai_paysage_correspondance
-    df_raw = get_df_fresq_raw(raw_data_suffix)
-    data = df_raw.data.to_list()
-    data_etab = []
-    for d in data:
+    data_etab, seen = [], set()
+    for e in iter_fresq_raw(raw_data_suffix):
+        d = e['data']
         etab_elt = {}
         for f in d:
             if '_etablissement' in f and isinstance(d[f], str):
                 etab_elt[f] = d[f]
-        if etab_elt not in data_etab:
+        key = get_canonical_key(etab_elt)
+        if key not in seen:
+            seen.add(key)
             data_etab.append(etab_elt)
-    df_etabs = pd.DataFrame(data_etab)
-    uais = list(set(df_etabs.uai_etablissement.to_list()))
-    if(len(uais) != len(df_etabs)):
-        logger.debug(f'WARNING !! nb_uai = {len(uais)} vs nb_etabs = {len(df_etabs)}')
-        df_count = pd.DataFrame(df_etabs.uai_etablissement.value_counts())
-        df_count_dup = df_count[df_count.uai_etablissement > 1]
-        logger.debug(df_count_dup)
-        for uai_pb in df_count_dup.index.to_list():
-            logger.debug(uai_pb)
-            logger.debug(df_etabs[df_etabs.uai_etablissement.apply(lambda x: x == uai_pb)].to_dict())
+    etabs_with_uai = [e for e in data_etab if isinstance(e.get('uai_etablissement'), str) and e['uai_etablissement']]
+    nb_no_uai = len(data_etab) - len(etabs_with_uai)
+    if nb_no_uai:
+        logger.debug(f'data_quality;paysage;noUAI;nb_etabs;{nb_no_uai}')
+    uais = list(set([e['uai_etablissement'] for e in etabs_with_uai]))
+    if(len(uais) != len(etabs_with_uai)):
+        logger.debug(f'WARNING !! nb_uai = {len(uais)} vs nb_etabs = {len(etabs_with_uai)}')
+        for conflict in get_duplicate_uais(data_etab):
+            logger.debug(f"data_quality;paysage;duplicate_uai;{conflict['uai']};{conflict['nb_versions']};{','.join(conflict['fields'])}")
     logger.debug(f'Number UAI (main) found = {len(uais)}')
     #tmp = []
     #for d in data:
@@ -79,11 +90,15 @@ def get_etabs(raw_data_suffix):
     
 
     paysage_uai_map = {}
-    # first loop to populate the map     
-    for uai in uais:
-        get_paysage_search(uai)
+    paysage_structures.clear()
+    cache_paysage_uai.evict()
+    nb_cached = len([uai for uai in uais if uai in cache_paysage_uai])
+    logger.debug(f'{nb_cached} UAI already resolved in cache, {len(uais) - nb_cached} to ask to paysage')
+    # first loop to populate the map
+    with ThreadPoolExecutor(max_workers=PAYSAGE_NB_WORKERS) as executor:
+        list(executor.map(get_paysage_search, uais))
     
-    new_data = []
+    new_data, seen = [], set()
     for d in data_etab:
         uai = d.get('uai_etablissement')
         if not isinstance(uai, str):
@@ -113,7 +128,9 @@ def get_etabs(raw_data_suffix):
             d['paysage_elt_to_use'] = paysage
             d['paysage_elt_to_use']['uai_to_paysage_method'] = 'successeur'
         final_uai_paysage_correspondance[uai] = d
-        if d not in new_data:
+        key = get_canonical_key(d)
+        if key not in seen:
+            seen.add(key)
             new_data.append(d)
     df_new = pd.DataFrame(new_data)
     current_file = get_etab_filename(raw_data_suffix)
@@ -123,8 +140,31 @@ def get_etabs(raw_data_suffix):
     upload_object('fresq', current_file, current_file)
     pickle.dump(final_uai_paysage_correspondance, open('final_uai_paysage_correspondance.pkl', 'wb'))
     upload_object('fresq', 'final_uai_paysage_correspondance.pkl', 'final_uai_paysage_correspondance.pkl')
+    http_client.log_stats()
     save_logs()
 
+def get_canonical_key(elt):
+    # equal dicts, whatever their keys order, get the same key
+    return json.dumps(elt, sort_keys=True, default=str)
+
+def get_duplicate_uais(data_etab):
+    """UAIs with several versions of their etablissement fields, and the fields that differ."""
+    versions = {}
+    for etab_elt in data_etab:
+        uai = etab_elt.get('uai_etablissement')
+        # etabs without uai are not versions of a same etablissement
+        if not uai:
+            continue
+        versions.setdefault(uai, []).append(etab_elt)
+    conflicts = []
+    for uai, etab_elts in versions.items():
+        if len(etab_elts) < 2:
+            continue
+        fields = sorted(set([f for e in etab_elts for f in e]))
+        fields = [f for f in fields if len(set([e.get(f) for e in etab_elts])) > 1]
+        conflicts.append({'uai': uai, 'nb_versions': len(etab_elts), 'fields': fields, 'versions': etab_elts})
+    return conflicts
+
 def get_paysage_infos(paysage_elt):
     new = {}
     geoloc = None
@@ -141,21 +181,34 @@ def get_paysage_infos(paysage_elt):
         new['geoloc'] = geoloc
     return new
 
-@retry(delay=300, tries=3, logger=logger)
 def get_paysage(paysage_id):
+    if paysage_id in paysage_structures:
+        return paysage_structures[paysage_id]
+    structure = get_paysage_api(paysage_id)
+    with paysage_lock:
+        paysage_structures[paysage_id] = structure
+    return structure
+
+@retry(delay=10, backoff=2, tries=3, logger=logger)
+def get_paysage_api(paysage_id):
     #print(paysage_id)
     url=f'{PAYSAGE_URL}/autocomplete?query={paysage_id}&limit=50&types=structures'
-    response = requests.get(url, headers=headers).json()
+    response = http_client.get(url, headers=headers).json()
     assert (len(response['data'])==1)
     return response['data'][0]
 
-@retry(delay=300, tries=3, logger=logger)
+@retry(delay=10, backoff=2, tries=3, logger=logger)
 def get_paysage_search(uai):
     global paysage_uai_map
     if uai in paysage_uai_map:
         return paysage_uai_map[uai]
+    cached = cache_paysage_uai.get(uai)
+    if cached is not None:
+        with paysage_lock:
+            paysage_uai_map[uai] = cached
+        return cached
     url=f'{PAYSAGE_URL}/autocomplete?query={uai}&limit=50&types=structures'
-    response = requests.get(url, headers=headers).json()
+    response = http_client.get(url, headers=headers).json()
     data, data_active = [], []
     for d in response['data']:
         if uai in d.get('identifiers') and d.get('isDeleted') is False:
@@ -177,13 +230,15 @@ def get_paysage_search(uai):
     if len(data_active) == 0 and data:
         successeurs = get_paysage_successeurs(data[0]['id'])
     ans = {'data': data_active, 'parents':parents, 'successeurs': successeurs}
-    paysage_uai_map[uai] = ans
+    cache_paysage_uai[uai] = ans
+    with paysage_lock:
+        paysage_uai_map[uai] = ans
     return ans
 
-@retry(delay=300, tries=3, logger=logger)
+@retry(delay=10, backoff=2, tries=3, logger=logger)
 def get_paysage_parents(paysage_id):
     url = f"{PAYSAGE_URL}/relations?filters[relationTag]=structure-interne&filters[relatedObjectId]={paysage_id}"
-    response_data = requests.get(url, headers=headers).json()['data']
+    response_data = http_client.get(url, headers=headers).json()['data']
     actives = []
     for d in response_data:
         if d.get('endDate') is None and (d.get('active') is not False):
@@ -193,9 +248,9 @@ def get_paysage_parents(paysage_id):
     parents = [get_paysage(k['resourceId']) for k in actives]
     return parents
 
-@retry(delay=300, tries=3, logger=logger)
+@retry(delay=10, backoff=2, tries=3, logger=logger)
 def get_paysage_successeurs(paysage_id):
     url = f"{PAYSAGE_URL}/relations?filters[relationTag]=structure-predecesseur&filters[relatedObjectId]={paysage_id}&sort=-startDate"
-    response_data = requests.get(url, headers=headers).json()['data']
+    response_data = http_client.get(url, headers=headers).json()['data']
     successeurs = [get_paysage(k['resourceId']) for k in response_data]
     return successeurs
@@ -0,0 +1,77 @@
+import os
+
+from project.server.main.elastic import get_mappings_etab, get_mappings_fresq, get_mappings_mentions, refresh_index, reset_index
+from project.server.main.format import format_record, location_registry
+from project.server.main.load import bulk_index, index_file, load_metiers
+from project.server.main.logger import get_logger
+from project.server.main.mongo import add_collection_to_aliases, insert_documents, reset_collection
+from project.server.main.transform import add_to_mentions, get_fresq_data, iter_enriched, save_mentions
+from project.server.main.utils import JsonlWriter, dumps_jsonl, get_etab_filename, get_formatted_data_filename, get_mentions_filename, get_transformed_data_filename, loads_json, prune_nulls, save_logs
+from project.server.main.utils_swift import upload_object
+
+logger = get_logger(__name__)
+
+# formatted records sent together to elastic and mongo
+STREAM_BATCH_SIZE = int(os.getenv('STREAM_BATCH_SIZE', 500))
+
+
+def load_batch(index_name, batch):
+    nb_indexed = bulk_index(index_name, batch)
+    # pymongo adds an _id to the inserted documents, they get a copy
+    nb_inserted = insert_documents(index_name, [dict(doc) for doc in batch])
+    return nb_indexed, nb_inserted
+
+
+def stream_fresq(raw_data_suffix='latest', index_name=None, nb_workers=None):
+    """Transform, format and load the formations in a single pass.
+
+    Each enriched formation goes straight through format_record to elastic and mongo, by
+    batches of STREAM_BATCH_SIZE. The transformed, formatted and mentions files are still
+    written and uploaded, but never read back: the mentions and etabs indexes are loaded
+    from the local files. get_etabs must have run before.
+    """
+    logger.debug('>>>>>>>>>> STREAM TRANSFORM FORMAT LOAD >>>>>>>>>>')
+    if index_name is None:
+        index_name = f'fresq-{raw_data_suffix}'
+    fresq_data = get_fresq_data(raw_data_suffix)
+    reset_index(index=index_name, mappings=get_mappings_fresq())
+    reset_collection(index_name)
+    transformed_data_filename = get_transformed_data_filename(raw_data_suffix)
+    formatted_data_filename = get_formatted_data_filename(raw_data_suffix)
+    mentions_map, batch = {}, []
+    location_registry.clear()
+    nb_records, nb_indexed, nb_inserted = 0, 0, 0
+    with JsonlWriter(transformed_data_filename) as transformed_writer, JsonlWriter(formatted_data_filename) as formatted_writer:
+        for elt in iter_enriched(fresq_data, nb_workers):
+            # same line as to_jsonl writes, and format gets what it used to read back from it
+            line = dumps_jsonl(elt)
+            transformed_writer.write_line(line)
+            add_to_mentions(mentions_map, elt)
+            formatted = prune_nulls(format_record(loads_json(line)))
+            formatted_writer.write(formatted, prune=False)
+            batch.append(formatted)
+            nb_records += 1
+            if len(batch) >= STREAM_BATCH_SIZE:
+                nb_batch_indexed, nb_batch_inserted = load_batch(index_name, batch)
+                nb_indexed += nb_batch_indexed
+                nb_inserted += nb_batch_inserted
+                batch = []
+                logger.debug(f'{nb_records} / {len(fresq_data)} formations loaded')
+    if batch:
+        nb_batch_indexed, nb_batch_inserted = load_batch(index_name, batch)
+        nb_indexed += nb_batch_indexed
+        nb_inserted += nb_batch_inserted
+    refresh_index(index_name)
+    add_collection_to_aliases(index_name)
+    logger.debug(f'{nb_records} formations: {nb_indexed} indexed in elastic, {nb_inserted} inserted in mongo ({index_name})')
+
+    upload_object('fresq', transformed_data_filename, transformed_data_filename)
+    upload_object('fresq', formatted_data_filename, formatted_data_filename)
+    save_mentions(mentions_map, raw_data_suffix)
+
+    load_metiers(raw_data_suffix, index_name.replace('fresq-', 'fresq-metiers-'))
+    # mentions and etabs from the files written by this run (save_mentions and get_etabs), not downloaded back
+    index_file(get_mentions_filename(raw_data_suffix), index_name.replace('fresq-', 'fresq-mentions-'), get_mappings_mentions())
+    index_file(get_etab_filename(raw_data_suffix), index_name.replace('fresq-', 'fresq-etablissements-'), get_mappings_etab())
+    save_logs()
+    return nb_records
@@ -1,62 +1,101 @@
-import requests
-from bs4 import BeautifulSoup
-import pandas as pd
-import os
+import gzip
 import json
+import os
+import zipfile
+
+import pandas as pd
+from lxml import etree
+
+from project.server.main import http_client
 from project.server.main.logger import get_logger
 from project.server.main.utils import download_file
+from project.server.main.utils_swift import download_object, upload_object
 logger = get_logger(__name__)
 
 URL_RNCP_DATA_GOUV = 'https://www.data.gouv.fr/api/2/datasets/5eebbc067a14b6fecc9c9976/resources/?page=1&type=update&page_size=6&q'
-df_rncp = None
+rncp_map = None
+
+def get_rncp_parsed_filename(rncp_suffix):
+    return f'rncp_parsed_{rncp_suffix}.jsonl.gz'
+
+def get_rncp_suffix(filename):
+    return filename.split('/')[-1].replace('export-fiches-rncp-v4-1-', '').replace('.zip', '')
 
 def get_rncp():
     logger.debug('>>>>> get RNCP >>>>>')
-    r = requests.get(URL_RNCP_DATA_GOUV).json()['data']
+    r = http_client.get(URL_RNCP_DATA_GOUV).json()['data']
     for dataset in r:
         if 'export-fiches-rncp-v4-1' in dataset['title'] and 'csv' not in dataset['title']:
             break
     dataset_url = dataset['url']
-    # dowload and upload to OVH
-    rncp_zip_file = download_file(dataset_url, True)
-    rncp_suffix = rncp_zip_file.replace('export-fiches-rncp-v4-1-', '').replace('.zip', '')
-    os.system(f'unzip {rncp_zip_file}')
-    rncp_filename = None
-    for f in os.listdir():
-        if ('RNCP' in f) and (rncp_suffix in f) and ('xml' in f):
-            rncp_filename = f
-    logger.debug(f'starting to parse {rncp_filename} ...')
-    xml = open(rncp_filename, 'r').read()
-    soup = BeautifulSoup(xml, 'xml')
-    x = soup.find_all('FICHE')
-    parsed = []
-    for ix, fiche in enumerate(x):
-        if ix%5000==0:
-            logger.debug(f'parsing RNCP {ix}/{len(x)}')
-        parsed.append(parse_fiche_rncp(fiche))
-    rncp_parsed_filename = 'rncp_parsed_latest.json'
-    json.dump(parsed, open(rncp_parsed_filename, 'w'))
-    df_rncp = pd.DataFrame(pd.read_json(rncp_parsed_filename)).set_index('numero_fiche')
+    # the parsed referential of an export is computed once, then read back from the object storage
+    rncp_parsed_filename = get_rncp_parsed_filename(get_rncp_suffix(dataset_url))
+    if not os.path.exists(rncp_parsed_filename):
+        download_object('fresq', rncp_parsed_filename, rncp_parsed_filename)
+    if os.path.exists(rncp_parsed_filename):
+        logger.debug(f'reading parsed RNCP from {rncp_parsed_filename}')
+    else:
+        # dowload and upload to OVH
+        rncp_zip_file = download_file(dataset_url, True)
+        parse_rncp_zip(rncp_zip_file, rncp_parsed_filename)
+        upload_object('fresq', rncp_parsed_filename, rncp_parsed_filename)
+        os.remove(rncp_zip_file)
+    df_rncp = pd.read_json(rncp_parsed_filename, lines=True).set_index('numero_fiche')
     logger.debug(f'rncp object created with {len(df_rncp)} elements')
     return df_rncp
 
+def parse_rncp_zip(rncp_zip_file, rncp_parsed_filename):
+    rncp_suffix = get_rncp_suffix(rncp_zip_file)
+    tmp_filename = f'{rncp_parsed_filename}.tmp'
+    nb_fiches = 0
+    with zipfile.ZipFile(rncp_zip_file) as z:
+        rncp_filename = None
+        for f in z.namelist():
+            if ('RNCP' in f) and (rncp_suffix in f) and ('xml' in f):
+                rncp_filename = f
+        logger.debug(f'starting to parse {rncp_filename} ...')
+        with z.open(rncp_filename) as xml, gzip.open(tmp_filename, 'wt', compresslevel=6) as out:
+            # each FICHE is parsed then freed, the export is never loaded as a whole
+            for _, fiche in etree.iterparse(xml, events=('end',), tag='FICHE', huge_tree=True):
+                out.write(json.dumps(parse_fiche_rncp(fiche)))
+                out.write('\n')
+                fiche.clear()
+                while fiche.getprevious() is not None:
+                    del fiche.getparent()[0]
+                nb_fiches += 1
+                if nb_fiches % 5000 == 0:
+                    logger.debug(f'parsing RNCP {nb_fiches}')
+    os.replace(tmp_filename, rncp_parsed_filename)
+    logger.debug(f'{nb_fiches} RNCP fiches parsed in {rncp_parsed_filename}')
+    return rncp_parsed_filename
+
+def get_rncp_map():
+    """numero_fiche -> list of (position in the referential, slim rncp record)."""
+    df_rncp = get_rncp()
+    rncp_map = {}
+    for position, (numero_fiche, type_emploi_accessibles) in enumerate(zip(df_rncp.index, df_rncp['type_emploi_accessibles'])):
+        new_elt = {}
+        new_elt['rncp'] = numero_fiche
+        if isinstance(type_emploi_accessibles, str) and type_emploi_accessibles:
+            new_elt['type_emploi_accessibles'] = type_emploi_accessibles.strip()
+        rncp_map.setdefault(numero_fiche, []).append((position, new_elt))
+    logger.debug(f'rncp map created with {len(rncp_map)} elements')
+    return rncp_map
+
 def get_rncp_elt(num_rncps):
     ans = {'avec_rncp_infos': False, 'rncp_infos': {}}
     if not isinstance(num_rncps, list):
         return ans
-    global df_rncp
-    if df_rncp is None:
-        df_rncp = get_rncp()
-    df_tmp = df_rncp[df_rncp.index.isin(num_rncps)]#['type_emploi_accessibles']
-    rncp_infos = []
-    if len(df_tmp)>0:
-        for elt in df_tmp.reset_index().to_dict(orient='records'):
-            new_elt = {}
-            new_elt['rncp'] = elt['numero_fiche']
-            for f in ['type_emploi_accessibles']:
-                if elt.get(f):
-                    new_elt[f] = elt[f].strip()
-            rncp_infos.append(new_elt)
+    global rncp_map
+    if rncp_map is None:
+        rncp_map = get_rncp_map()
+    matches = []
+    for num_rncp in set(num_rncps):
+        matches += rncp_map.get(num_rncp, [])
+    if matches:
+        # referential order, as a filter on the referential would give
+        matches.sort(key=lambda m: m[0])
+        rncp_infos = [dict(new_elt) for _, new_elt in matches]
         return {'avec_rncp_infos': True, 'rncp_infos': rncp_infos}
     return ans
 
@@ -69,8 +108,8 @@ def parse_fiche_rncp(e):
               'ACTIF', 'DATE_DE_PUBLICATION']:
         elt[f.lower()] = get_value(e, f)
     certificateurs = []
-    if e.find('CERTIFICATEURS'):
-        certificateurs_xml = e.find('CERTIFICATEURS').find_all('CERTIFICATEUR')
+    if find(e, 'CERTIFICATEURS') is not None:
+        certificateurs_xml = find_all(find(e, 'CERTIFICATEURS'), 'CERTIFICATEUR')
         for c in certificateurs_xml:
             certif = {}
             siret = get_value(c, 'SIRET_CERTIFICATEUR')
@@ -82,8 +121,8 @@ def parse_fiche_rncp(e):
     elt['nb_certificateurs'] = len(certificateurs)
 
     partenaires = []
-    if e.find('PARTENAIRES'):
-        partenaires_xml = e.find('PARTENAIRES').find_all('PARTENAIRE')
+    if find(e, 'PARTENAIRES') is not None:
+        partenaires_xml = find_all(find(e, 'PARTENAIRES'), 'PARTENAIRE')
         for p in partenaires_xml:
             part = {}
             siret = get_value(p, 'SIRET_PARTENAIRE')
@@ -105,8 +144,8 @@ def parse_fiche_rncp(e):
     elt['activites_visees'] = get_value(e, '')
     
     romes = []
-    if e.find('CODES_ROME'):
-        codes_rome = e.find('CODES_ROME').find_all('ROME')
+    if find(e, 'CODES_ROME') is not None:
+        codes_rome = find_all(find(e, 'CODES_ROME'), 'ROME')
         for c in codes_rome:
             code = get_value(c, 'CODE')
             label = get_value(c, 'LIBELLE')
@@ -115,8 +154,8 @@ def parse_fiche_rncp(e):
     elt['codes_rome'] = romes
     
     competences = []
-    if e.find('BLOCS_COMPETENCES'):
-        bloc_comp = e.find('BLOCS_COMPETENCES').find_all('BLOC_COMPETENCES')
+    if find(e, 'BLOCS_COMPETENCES') is not None:
+        bloc_comp = find_all(find(e, 'BLOCS_COMPETENCES'), 'BLOC_COMPETENCES')
         for b in bloc_comp:
             competence = {}
             for f in ['CODE', 'LISTE_COMPETENCES', 'MODALITES_EVALUATION']:
@@ -127,8 +166,17 @@ def parse_fiche_rncp(e):
     
     return elt
 
+def find(x, l):
+    # first descendant element named l - like BeautifulSoup, an empty name finds nothing
+    if not l:
+        return None
+    return next(x.iterdescendants(l), None)
+
+def find_all(x, l):
+    return list(x.iterdescendants(l))
+
 def get_value(x, l):
-    n = x.find(l)
-    if n:
-        return n.get_text()
+    n = find(x, l)
+    if n is not None:
+        return ''.join(n.itertext())
     return None
@@ -1,8 +1,9 @@
-import requests
 import pandas as pd
 import os
 import json
+from io import BytesIO
 
+from project.server.main import http_client
 from project.server.main.logger import get_logger
 from project.server.main.utils import download_file, to_jsonl, get_filename
 from project.server.main.utils_swift import upload_object, download_object
@@ -51,14 +52,16 @@ def get_rncp2rome():
     global rome
     if rome is None:
         rome = get_rome()
-    r = requests.get(URL_CERTIF_DATA_GOUV).json()['data']
+    r = http_client.get(URL_CERTIF_DATA_GOUV).json()['data']
     for dataset in r:
         if ('opendata-certifinfo' in dataset['title']) and ('csv' in dataset['title']):
             break
     dataset_url = dataset['url']
     # dowload and upload to OVH
     # certifinfo_file = download_file(dataset_url, True) # does not work ??
-    df_cf = pd.read_csv(dataset_url, sep=';', encoding='iso-8859-1')
+    r_cf = http_client.get(dataset_url)
+    r_cf.raise_for_status()
+    df_cf = pd.read_csv(BytesIO(r_cf.content), sep=';', encoding='iso-8859-1')
     certifinfo_file = get_filename(dataset_url)
     df_cf.to_csv(certifinfo_file, index=False, sep=';')
     upload_object('fresq', certifinfo_file, certifinfo_file)
@@ -1,3 +1,5 @@
+import threading
+
 import pandas as pd
 from project.server.main.ods import get_ods_data
 from project.server.main.logger import get_logger
@@ -6,6 +8,10 @@ logger = get_logger(__name__)
 #URL_SISE = 'https://data.enseignementsup-recherche.gouv.fr/api/explore/v2.1/catalog/datasets/fr-esr-principaux-diplomes-et-formations-prepares-etablissements-publics/exports/csv?lang=en&timezone=Europe%2FBerlin&use_labels=true&delimiter=%3B'
 
 df_sise_dict, years_in_sise = None, []
+# per annee, inverted indexes of the SISE rows (inf -> row ids, uai -> row ids) and memo of the answers
+sise_indexes, sise_answers = {}, {}
+sise_lock = threading.Lock()
+SISE_FIELDS = ['gd_disciscipline_lib',  'discipline_lib', 'sect_disciplinaire_lib', 'disciplines_selection']
 
 def get_clean_sise_code_as_list(x):
     ans = []
@@ -36,6 +42,8 @@ def get_sise():
     df_sise['uai_fresq_split'] = df_sise.uai_fresq.fillna('').str.split('/')
     df_sise['inf_split'] = df_sise.inf.fillna('').str.split('/')
     years_in_sise = annees
+    sise_indexes.clear()
+    sise_answers.clear()
     df_sise_dict = {}
     df_sise_dict['all'] = df_sise
     for a in annees:
@@ -62,23 +70,48 @@ def get_sise_elt(uais, inf, annee):
         df_sise_dict, years_in_sise = get_sise()
 
     df_sise_annee = df_sise_dict[annee]
-    uais_set = set(uais) 
-    filter_uai = df_sise_annee.uai_fresq_split.apply(lambda x: bool(set(x) & uais_set))
-    filter_inf = df_sise_annee.inf_split.apply(lambda x: inf in x)
-    df_sise_filtered = df_sise_annee[filter_uai & filter_inf]
-    if len(df_sise_filtered) == 0:
+    index_inf, index_uai = get_sise_index(annee)
+    rows_inf = index_inf.get(inf)
+    if not rows_inf:
         return empty_ans
-
-    df_sise_final = df_sise_filtered
-
-    if len(df_sise_final) == 0:
+    rows_uai = set()
+    for uai in set(uais):
+        rows_uai.update(index_uai.get(uai, ()))
+    rows = tuple(sorted(rows_inf & rows_uai))
+    if len(rows) == 0:
         return empty_ans
-    ans = {'avec_sise_infos': True}
-    for k in ['gd_disciscipline_lib',  'discipline_lib', 'sect_disciplinaire_lib', 'disciplines_selection']:
-        df_test = df_sise_final[k].value_counts()
-        values = df_test.index.to_list()
-        ans[k] = values
-    return ans
-
 
+    key = (annee, rows)
+    if key not in sise_answers:
+        ans = {'avec_sise_infos': True}
+        if len(rows) == 1:
+            # value_counts of a single row is its non null value
+            for k in SISE_FIELDS:
+                value = df_sise_annee[k].iat[rows[0]]
+                ans[k] = [] if pd.isna(value) else [value]
+        else:
+            # same rows in the same order as a boolean filter would give, so the value_counts are identical
+            df_sise_final = df_sise_annee.iloc[list(rows)]
+            for k in SISE_FIELDS:
+                df_test = df_sise_final[k].value_counts()
+                values = df_test.index.to_list()
+                ans[k] = values
+        sise_answers[key] = ans
+    ans = sise_answers[key]
+    return {k: list(v) if isinstance(v, list) else v for k, v in ans.items()}
 
+def get_sise_index(annee):
+    """Inverted indexes inf -> row positions and uai -> row positions of the SISE rows of annee."""
+    if annee not in sise_indexes:
+        with sise_lock:
+            if annee not in sise_indexes:
+                df_sise_annee = df_sise_dict[annee]
+                index_inf, index_uai = {}, {}
+                for row, (infs, uais) in enumerate(zip(df_sise_annee.inf_split, df_sise_annee.uai_fresq_split)):
+                    for inf in infs:
+                        index_inf.setdefault(inf, set()).add(row)
+                    for uai in uais:
+                        index_uai.setdefault(uai, set()).add(row)
+                logger.debug(f'SISE index {annee}: {len(index_inf)} inf and {len(index_uai)} uai for {len(df_sise_annee)} rows')
+                sise_indexes[annee] = (index_inf, index_uai)
+    return sise_indexes[annee]
@@ -0,0 +1,178 @@
+import gzip
+import json
+import os
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Optional
+from urllib.parse import parse_qsl, urlencode, urlparse
+
+from project.server.main.logger import get_logger
+
+logger = get_logger(__name__)
+
+# upstreams served by the stand-in, each one under its own path prefix
+UPSTREAMS = {
+    'fresq': ['FRESQ_BASE_URL', 'FRESQ_DETAILS_URL'],
+    'paysage': ['PAYSAGE_URL'],
+}
+UPSTREAMS_DEFAULTS = {'FRESQ_DETAILS_URL': 'https://fresq.enseignementsup.gouv.fr'}
+
+
+def get_key(method: str, path: str, query: str = '', body: Optional[bytes] = None) -> str:
+    """Canonical key of a request: method, path, sorted query and sorted json body."""
+    key = f'{method.upper()} {path}'
+    if query:
+        key += '?' + urlencode(sorted(parse_qsl(query, keep_blank_values=True)))
+    if body:
+        try:
+            key += ' ' + json.dumps(json.loads(body), sort_keys=True)
+        except ValueError:
+            key += ' ' + body.decode('utf-8', errors='replace')
+    return key
+
+
+class Cassette:
+    """Recorded upstream answers, stored as gzipped jsonl."""
+
+    def __init__(self, filename: str):
+        self.filename = filename
+        self.interactions: Dict[str, dict] = {}
+        self.lock = threading.Lock()
+
+    def load(self) -> 'Cassette':
+        with gzip.open(self.filename, 'rt') as f:
+            for line in f:
+                interaction = json.loads(line)
+                self.interactions[interaction['key']] = interaction
+        logger.debug(f'{len(self.interactions)} interactions loaded from {self.filename}')
+        return self
+
+    def save(self) -> None:
+        with gzip.open(self.filename, 'wt') as f:
+            for interaction in self.interactions.values():
+                f.write(json.dumps(interaction))
+                f.write('\n')
+        logger.debug(f'{len(self.interactions)} interactions saved in {self.filename}')
+
+    def add(self, key: str, status: int, content_type: str, content: str) -> None:
+        with self.lock:
+            self.interactions[key] = {'key': key, 'status': status, 'content_type': content_type, 'content': content}
+
+    def get(self, key: str) -> Optional[dict]:
+        return self.interactions.get(key)
+
+
+class CassetteRecorder:
+    """http_client recorder keeping the answers of the FRESQ and Paysage APIs.
+
+    Only the requests under the upstream urls are kept, so that neither the
+    authentication nor any other service ends up in the cassette.
+    """
+
+    def __init__(self, cassette: Cassette):
+        self.cassette = cassette
+        self.prefixes = []
+        for upstream, env_variables in UPSTREAMS.items():
+            for env_variable in env_variables:
+                url = os.getenv(env_variable, UPSTREAMS_DEFAULTS.get(env_variable))
+                if url:
+                    self.prefixes.append((url.rstrip('/'), upstream))
+        # longest prefixes first
+        self.prefixes.sort(key=lambda p: -len(p[0]))
+        self.excluded = [url for url in [os.getenv('FRESQ_AUTHENT_URL')] if url]
+
+    def record(self, method: str, url: str, kwargs: dict, response) -> None:
+        if any(url.startswith(excluded) for excluded in self.excluded):
+            return
+        for prefix, upstream in self.prefixes:
+            if url.startswith(prefix):
+                break
+        else:
+            return
+        parsed = urlparse(url[len(prefix):])
+        body = None
+        if kwargs.get('json') is not None:
+            body = json.dumps(kwargs['json']).encode('utf-8')
+        key = get_key(method, f'/{upstream}{parsed.path}', parsed.query, body)
+        self.cassette.add(key, response.status_code, response.headers.get('Content-Type', 'application/json'), response.text)
+
+
+class StandinHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def send_body(self, status: int, content_type: str, body: bytes, headers: dict = None) -> None:
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for header, value in (headers or {}).items():
+            self.send_header(header, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def handle_request(self) -> None:
+        server = self.server
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length) if length else None
+        parsed = urlparse(self.path)
+        if server.latency:
+            time.sleep(server.latency * random.uniform(1 - server.jitter, 1 + server.jitter))
+        with server.lock:
+            server.nb_requests += 1
+        if parsed.path == '/auth':
+            token = {'access_token': 'standin', 'expires_in': 300, 'token_type': 'Bearer'}
+            return self.send_body(200, 'application/json', json.dumps(token).encode('utf-8'))
+        if server.error_rate and random.random() < server.error_rate:
+            with server.lock:
+                server.nb_errors += 1
+            return self.send_body(503, 'text/plain', b'injected error', {'Retry-After': str(server.retry_after)})
+        interaction = server.cassette.get(get_key(self.command, parsed.path, parsed.query, body))
+        if interaction is None:
+            with server.lock:
+                server.nb_missing += 1
+            logger.debug(f'no recorded answer for {self.command} {self.path}')
+            return self.send_body(404, 'text/plain', b'not recorded')
+        return self.send_body(interaction['status'], interaction['content_type'], interaction['content'].encode('utf-8'))
+
+    do_GET = handle_request
+    do_POST = handle_request
+
+
+class StandinServer(ThreadingHTTPServer):
+    """Local server replaying a cassette, with configurable latency and error injection."""
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(self, cassette: Cassette, port: int = 0, latency: float = 0, jitter: float = 0.2,
+                 error_rate: float = 0, retry_after: int = 0):
+        super().__init__(('127.0.0.1', port), StandinHandler)
+        self.cassette = cassette
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        self.lock = threading.Lock()
+        self.nb_requests, self.nb_errors, self.nb_missing = 0, 0, 0
+
+    @property
+    def url(self) -> str:
+        return f'http://127.0.0.1:{self.server_port}'
+
+    def start(self) -> 'StandinServer':
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        logger.debug(f'stand-in server listening on {self.url}')
+        return self
+
+    def get_env(self) -> dict:
+        """Environment pointing the harvesters to the stand-in, to set before importing them."""
+        return {
+            'FRESQ_AUTHENT_URL': f'{self.url}/auth',
+            'FRESQ_BASE_URL': f'{self.url}/fresq',
+            'FRESQ_DETAILS_URL': f'{self.url}/fresq',
+            'PAYSAGE_URL': f'{self.url}/paysage',
+        }
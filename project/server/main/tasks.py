@@ -11,6 +11,7 @@ from project.server.main.load import load_fresq
 from project.server.main.logger import get_logger
 from project.server.main.mongo import load_mongo, update_mongo_alias
 from project.server.main.paysage import get_etabs
+from project.server.main.pipeline import stream_fresq
 from project.server.main.transform import get_mentions, transform_raw_data
 from project.server.main.utils import get_today
 
@@ -21,6 +22,9 @@ def create_dump_fresq():
 
 def create_task_fresq(arg):
     extract = arg.get('extract', True)
+    incremental = arg.get('incremental', False)
+    resume = arg.get('resume', False)
+    stream = arg.get('stream', False)
     transform = arg.get('transform', True)
     format = arg.get('format', True)
     load = arg.get('load', True)
@@ -39,21 +43,26 @@ def create_task_fresq(arg):
     #    return
 
     if extract:
-        _ = extract_from_fresq()
+        _ = extract_from_fresq(incremental=incremental, resume=resume)
 
-    if transform:
-        # etabs
+    if stream:
+        # transform, format and load fused, records never go back through the intermediate files
         get_etabs(raw_data_suffix)
-        transform_raw_data(raw_data_suffix)
-        # mentions
-        get_mentions(raw_data_suffix)
+        stream_fresq(raw_data_suffix, index_name)
+    else:
+        if transform:
+            # etabs
+            get_etabs(raw_data_suffix)
+            transform_raw_data(raw_data_suffix)
+            # mentions
+            get_mentions(raw_data_suffix)
 
-    if format:
-        format_transformed_data(raw_data_suffix)
+        if format:
+            format_transformed_data(raw_data_suffix)
 
-    if load:
-        load_fresq(raw_data_suffix, index_name)
-        load_mongo(raw_data_suffix, index_name)
+        if load:
+            load_fresq(raw_data_suffix, index_name)
+            load_mongo(raw_data_suffix, index_name)
 
     if change_alias:
         dated_suffix = index_name.replace('fresq-', '')
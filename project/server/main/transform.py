@@ -1,15 +1,16 @@
 import json
 import math
+import multiprocessing
 import os
 import requests
 from retry import retry
 import pandas as pd
 import datetime
 import jsonlines
-from project.server.main.utils import get_raw_data_filename, get_transformed_data_filename, to_jsonl, normalize, get_mentions_filename, get_etab_filename, get_df_fresq_raw, save_logs
+from project.server.main.utils import get_raw_data_filename, get_transformed_data_filename, to_jsonl, normalize, get_mentions_filename, get_etab_filename, iter_fresq_raw, prepare_fork, save_logs, dumps_jsonl, loads_json
 from project.server.main.paysage import enrich_with_paysage
 from project.server.main.monmaster import get_monmaster_elt
-from project.server.main.sise import get_years_in_sise, get_sise_elt, get_clean_sise_code_as_list
+from project.server.main.sise import get_years_in_sise, get_sise_elt, get_sise_index, get_clean_sise_code_as_list
 from project.server.main.rncp import get_rncp_elt
 from project.server.main.rome import get_rome_elt
 from project.server.main.logger import get_logger
@@ -20,10 +21,29 @@ from project.server.main.etapes import clean_etapes
 logger = get_logger(__name__)
 
 raw_data_suffix = 'latest'
+# processes enriching the formations, 1 to enrich them in the current process
+TRANSFORM_NB_WORKERS = int(os.getenv('TRANSFORM_NB_WORKERS', os.cpu_count() or 1))
 
-df_fresq_raw = None
 fresq_enriched = None
 
+def iter_raw_formations(raw_data_suffix):
+    # raw records are streamed from the dump, never loaded as a whole
+    for e in iter_fresq_raw(raw_data_suffix):
+        d = e['data']
+        for f in ['recordId', 'collectionId', 'bucketId']:
+            if e.get(f):
+                d[f] = e.get(f)
+        yield d
+
+def add_to_inf_group(inf_group, d):
+    if 'uai_etablissement' in d:
+        uai = d.get('uai_etablissement')
+    else:
+        nb_elts = len(inf_group)
+        uai = f'uai_absent_{nb_elts}'
+        #logger.debug(f'pas de UAI pour inf {current_inf} - {uai}')
+    inf_group[uai] = d
+
 def group_by_inf(raw_data):
     logger.debug(f'raw fresq_data len = {len(raw_data)}')
     inf_dict = {}
@@ -31,19 +51,44 @@ def group_by_inf(raw_data):
         current_inf = d['inf']
         if current_inf not in inf_dict:
             inf_dict[current_inf] = {}
-        if 'uai_etablissement' in d:
-            uai = d.get('uai_etablissement')
-        else:
-            nb_elts = len(inf_dict[current_inf])
-            uai = f'uai_absent_{nb_elts}'
-            #logger.debug(f'pas de UAI pour inf {current_inf} - {uai}')
-        inf_dict[current_inf][uai] = d
+        add_to_inf_group(inf_dict[current_inf], d)
     inf_data = []
     for inf in inf_dict:
         inf_data.append(merge(inf, inf_dict[inf]))
     logger.debug(f'after INF group by fresq_data len = {len(inf_data)}')
     return inf_data
 
+class GroupedFormations:
+    """Raw formations grouped by inf, as group_by_inf does, without holding them in memory.
+
+    The records are spilled to a local jsonl file and only their offsets are kept by inf, in
+    the order the infs are first seen. Iterating reads back and merges one inf at a time.
+    """
+
+    def __init__(self, raw_data, filename):
+        self.filename = filename
+        self.offsets = {}
+        nb_records = 0
+        with open(filename, 'wb') as f:
+            for d in raw_data:
+                self.offsets.setdefault(d['inf'], []).append(f.tell())
+                f.write(dumps_jsonl(d, prune=False))
+                nb_records += 1
+        logger.debug(f'raw fresq_data len = {nb_records}')
+        logger.debug(f'after INF group by fresq_data len = {len(self.offsets)}')
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __iter__(self):
+        with open(self.filename, 'rb') as f:
+            for inf, offsets in self.offsets.items():
+                inf_group = {}
+                for offset in offsets:
+                    f.seek(offset)
+                    add_to_inf_group(inf_group, loads_json(f.readline()))
+                yield merge(inf, inf_group)
+
 def merge(inf, list_elts):
     assert(len(list_elts)>0)
     ans = {'inf': inf}
@@ -90,44 +135,57 @@ def test(raw_data_suffix='latest'):
     global fresq_enriched
     logger.debug('>>>>>>>>>> TRANSFORM >>>>>>>>>>')
     logger.debug(f'start fresq data from {raw_data_suffix} enrichment')
-    global df_fresq_raw
-    if df_fresq_raw is None:
-        df_fresq_raw = get_df_fresq_raw(raw_data_suffix)
-    raw_data = df_fresq_raw.to_dict(orient='records')
-    raw_data2 = []
-    for e in raw_data:
-        d = e['data']
-        for f in ['recordId', 'collectionId', 'bucketId']:
-            if e.get(f):
-                d[f] = e.get(f)
-        raw_data2.append(d)
-    raw_data_etapes_clean = clean_etapes(raw_data2)
+    raw_data_etapes_clean = list(clean_etapes(iter_raw_formations(raw_data_suffix)))
     return raw_data_etapes_clean
 
-def transform_raw_data(raw_data_suffix='latest'):
+def load_referentials():
+    get_years_in_sise()
+    get_sise_index('all')
+    get_rncp_elt([])
+    get_rome_elt([])
+    enrich_with_paysage({'etablissements': []})
+
+def enrich_elt(fresq_elt):
+    return enrich_fresq_elt(enrich_with_paysage(fresq_elt))
+
+def iter_enriched(fresq_data, nb_workers=None):
+    """Enriched formations, in the order of fresq_data."""
+    nb_workers = nb_workers or TRANSFORM_NB_WORKERS
+    if nb_workers <= 1:
+        for ix, e in enumerate(fresq_data):
+            yield enrich_elt(e)
+            if (ix + 1) % 50 == 0:
+                logger.debug(f'{ix + 1} / {len(fresq_data)}')
+        return
+    # referentials are loaded before forking, the workers share them copy-on-write
+    # fork also keeps the hash seed, so the set-based lists come out in the same order
+    load_referentials()
+    prepare_fork()
+    chunksize = max(1, min(100, len(fresq_data) // (4 * nb_workers)))
+    logger.debug(f'enriching {len(fresq_data)} formations with {nb_workers} processes')
+    with multiprocessing.get_context('fork').Pool(nb_workers) as pool:
+        for ix, elt in enumerate(pool.imap(enrich_elt, fresq_data, chunksize=chunksize)):
+            yield elt
+            if (ix + 1) % 1000 == 0:
+                logger.debug(f'{ix + 1} / {len(fresq_data)}')
+
+def enrich_all(fresq_data, nb_workers=None):
+    return list(iter_enriched(fresq_data, nb_workers))
+
+def get_grouped_data_filename(raw_data_suffix):
+    return f'fresq_grouped_{raw_data_suffix}.jsonl'
+
+def get_fresq_data(raw_data_suffix='latest'):
+    # raw records are cleaned and spilled one by one, and grouped by inf as they are read back
+    raw_data_etapes_clean = clean_etapes(iter_raw_formations(raw_data_suffix))
+    return GroupedFormations(raw_data_etapes_clean, get_grouped_data_filename(raw_data_suffix))
+
+def transform_raw_data(raw_data_suffix='latest', nb_workers=None):
     global fresq_enriched
     logger.debug('>>>>>>>>>> TRANSFORM >>>>>>>>>>')
     logger.debug(f'start fresq data from {raw_data_suffix} enrichment')
-    global df_fresq_raw
-    if df_fresq_raw is None:
-        df_fresq_raw = get_df_fresq_raw(raw_data_suffix)
-    raw_data = df_fresq_raw.to_dict(orient='records')
-    raw_data2 = []
-    for e in raw_data:
-        d = e['data']
-        for f in ['recordId', 'collectionId', 'bucketId']:
-            if e.get(f):
-                d[f] = e.get(f)
-        raw_data2.append(d)
-    raw_data_etapes_clean = clean_etapes(raw_data2)
-    fresq_data = group_by_inf(raw_data_etapes_clean)
-    fresq_data_with_paysage = [enrich_with_paysage(fresq_elt) for fresq_elt in fresq_data]
-    fresq_enriched = []
-    for ix, e in enumerate(fresq_data_with_paysage):
-        elt = enrich_fresq_elt(e)
-        fresq_enriched.append(elt)
-        if len(fresq_enriched) % 50 == 0:
-            logger.debug(f'{len(fresq_enriched)} / {len(fresq_data_with_paysage)}')
+    fresq_data = get_fresq_data(raw_data_suffix)
+    fresq_enriched = enrich_all(fresq_data, nb_workers)
     transformed_data_filename = get_transformed_data_filename(raw_data_suffix)
     os.system(f'rm -rf {transformed_data_filename}')
     to_jsonl(fresq_enriched, transformed_data_filename)
@@ -149,32 +207,38 @@ def get_mentions(raw_data_suffix='latest'):
     logger.debug('>>>>>>>>>> TRANSFORM MENTIONS >>>>>>>>>>')
     mentions_map = {}
     for e in fresq_enriched:
-        if not isinstance(e.get('mention_id'), str):
-            continue
-        if e.get('mention_id') not in mentions_map:
-            current_mention = {'formations': []}
-            for f in ['mention_id', 'intitule_officiel', 'secteur', 'domaines',
-                  'mots_cles', 'specialites',
-                  'entityfishing_infos', 'has_entityfishing_infos',
-                  'monmaster_infos', 'has_monmaster_infos',
-                  'rncp_infos', 'has_rncp_infos',
-                  'rome_infos', 'has_rome_infos',
-                  'secteur_disciplinaire_sise',
-                  'domaine_rattachement_1_cti', 'domaine_rattachement_2_cti','domaine_rattachement_autre_cti',
-                  'libelle_formation_2', 'mention_normalized',
-                  'libelle_type_diplome', 'code_sise',
-                  'sise_secteur_disciplinaire', 'sise_discipline', 'sise_grande_discipline'
-                 ]:
-                if e.get(f):
-                    current_mention[f] = e.get(f)
-            mentions_map[e['mention_id']] = current_mention
-        current_formation = {}
-        for f in ['inf', 'fresq_etab_id', 'geoloc', 'mention_id',
-                'nom_commun_etablissement', 'nom_etablissement', 'uai_etablissement', 'academie', 'paysage_id_to_use']:
+        add_to_mentions(mentions_map, e)
+    save_mentions(mentions_map, raw_data_suffix)
+
+def add_to_mentions(mentions_map, e):
+    if not isinstance(e.get('mention_id'), str):
+        return
+    if e.get('mention_id') not in mentions_map:
+        current_mention = {'formations': []}
+        for f in ['mention_id', 'intitule_officiel', 'secteur', 'domaines',
+              'mots_cles', 'specialites',
+              'entityfishing_infos', 'has_entityfishing_infos',
+              'monmaster_infos', 'has_monmaster_infos',
+              'rncp_infos', 'has_rncp_infos',
+              'rome_infos', 'has_rome_infos',
+              'secteur_disciplinaire_sise',
+              'domaine_rattachement_1_cti', 'domaine_rattachement_2_cti','domaine_rattachement_autre_cti',
+              'libelle_formation_2', 'mention_normalized',
+              'libelle_type_diplome', 'code_sise',
+              'sise_secteur_disciplinaire', 'sise_discipline', 'sise_grande_discipline'
+             ]:
             if e.get(f):
-                current_formation[f] = e[f]
-        mentions_map[e['mention_id']]['formations'].append(current_formation)
-        mentions_map[e['mention_id']]['nb_formations'] = len(mentions_map[e['mention_id']]['formations'])
+                current_mention[f] = e.get(f)
+        mentions_map[e['mention_id']] = current_mention
+    current_formation = {}
+    for f in ['inf', 'fresq_etab_id', 'geoloc', 'mention_id',
+            'nom_commun_etablissement', 'nom_etablissement', 'uai_etablissement', 'academie', 'paysage_id_to_use']:
+        if e.get(f):
+            current_formation[f] = e[f]
+    mentions_map[e['mention_id']]['formations'].append(current_formation)
+    mentions_map[e['mention_id']]['nb_formations'] = len(mentions_map[e['mention_id']]['formations'])
+
+def save_mentions(mentions_map, raw_data_suffix='latest'):
     x = list(mentions_map.values())
     logger.debug(f'{len(x)} mentions detected')
     df_mentions = pd.DataFrame(x)
@@ -1,4 +1,5 @@
 from jsonschema import exceptions, validate
+import gzip
 import json
 import pandas as pd
 import os
@@ -6,9 +7,15 @@ import shutil
 import re
 import json
 import string
+import sys
+import threading
+import time
 import unicodedata
-import requests
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
 from tokenizers import normalizers
 from tokenizers.normalizers import BertNormalizer, Sequence, Strip
 from tokenizers import pre_tokenizers
@@ -16,11 +23,41 @@ from tokenizers import pre_tokenizers
 from tokenizers import pre_tokenizers
 from tokenizers.pre_tokenizers import Whitespace
 
+from project.server.main import cache, http_client
 from project.server.main.utils_swift import upload_object, download_object
 from project.server.main.logger import get_logger
 logger = get_logger(__name__)
 
 import datetime
+from functools import lru_cache
+
+# seconds given to the background threads to stop before forking
+PREPARE_FORK_TIMEOUT = float(os.getenv('PREPARE_FORK_TIMEOUT', 2))
+
+def prepare_fork():
+    """Release the threads, sockets and SQLite connections left open before forking workers.
+
+    A child forked while another thread holds a lock (logging, sqlite, a connection pool) can
+    deadlock on it, and SQLite connections must not be used across a fork.
+    """
+    extract = sys.modules.get('project.server.main.extract')
+    if extract is not None:
+        extract.shutdown_detail_executor()
+    # elastic and mongo clients, e.g. opened by the stream pipeline to reset the index and collection
+    for module_name in ['project.server.main.elastic', 'project.server.main.mongo']:
+        module = sys.modules.get(module_name)
+        if module is not None:
+            module.close_client()
+    http_client.close_sessions()
+    cache.close_connections()
+    # closed clients stop their background threads asynchronously
+    deadline = time.monotonic() + PREPARE_FORK_TIMEOUT
+    for thread in threading.enumerate():
+        if thread is not threading.current_thread():
+            thread.join(max(0, deadline - time.monotonic()))
+    other_threads = [t.name for t in threading.enumerate() if t is not threading.current_thread()]
+    if other_threads:
+        logger.debug(f'{len(other_threads)} threads still alive before forking: {other_threads}')
 
 def save_logs():
     today = get_today()
@@ -31,6 +68,53 @@ def get_df_fresq_raw(raw_data_suffix):
     download_object('fresq', raw_data_filename, raw_data_filename)
     return pd.read_json(raw_data_filename)
 
+def iter_fresq_raw(raw_data_suffix):
+    """Raw records of the dump, read one by one from the gzip stream."""
+    raw_data_filename = get_raw_data_filename(raw_data_suffix)
+    download_object('fresq', raw_data_filename, raw_data_filename)
+    with gzip.open(raw_data_filename, 'rt') as f:
+        yield from iter_json_array(f)
+
+def iter_json_array(f, chunk_size=1024*1024):
+    """Elements of the json array read from the text stream f, parsed as they come."""
+    decoder = json.JSONDecoder()
+    buffer, pos = '', 0
+    # what comes next: '[', the first element (or ']'), ',' (or ']'), an element
+    expected = '['
+    while True:
+        while pos < len(buffer) and buffer[pos] in ' \t\n\r':
+            pos += 1
+        if pos == len(buffer):
+            chunk = f.read(chunk_size)
+            if not chunk:
+                raise ValueError('truncated json array')
+            buffer, pos = chunk, 0
+            continue
+        c = buffer[pos]
+        if expected in ['first', ','] and c == ']':
+            return
+        if expected in ['[', ',']:
+            if c != expected:
+                raise ValueError(f'expected {expected} in json array, got {c}')
+            pos += 1
+            expected = 'first' if expected == '[' else 'element'
+            continue
+        try:
+            elt, end = decoder.raw_decode(buffer, pos)
+            # an element ending the buffer may be a cut number, e.g. 1 of 1e-7
+            is_complete = end < len(buffer) and buffer[end] in ' \t\n\r,]'
+        except json.JSONDecodeError:
+            is_complete = False
+        if not is_complete:
+            chunk = f.read(max(chunk_size, len(buffer) - pos))
+            if not chunk:
+                raise ValueError('truncated json array')
+            buffer, pos = buffer[pos:] + chunk, 0
+            continue
+        yield elt
+        expected = ','
+        pos = end
+
 def get_filename_from_cd(cd: str):
     """ Get filename from content-disposition """
     if not cd:
@@ -41,7 +125,7 @@ def get_filename_from_cd(cd: str):
     return fname[0]
 
 def get_filename(url):
-    with requests.get(url, stream=True, verify=False) as r:
+    with http_client.get(url, stream=True, verify=False) as r:
         r.raise_for_status()
         try:
             local_filename = get_filename_from_cd(r.headers.get('content-disposition')).replace('"', '')
@@ -51,7 +135,7 @@ def get_filename(url):
 
 def download_file(url: str, upload_to_object_storage: bool = True, destination: str = None) -> str:
     start = datetime.datetime.now()
-    with requests.get(url, stream=True, verify=False) as r:
+    with http_client.get(url, stream=True, verify=False) as r:
         r.raise_for_status()
         try:
             local_filename = get_filename_from_cd(r.headers.get('content-disposition')).replace('"', '')
@@ -124,12 +208,117 @@ def clean_json_old(elt):
             del elt[f]
     return elt
 
+# orjson when installed, the standard json module otherwise
+JSON_BACKEND = os.getenv('JSON_BACKEND', 'orjson' if orjson else 'json')
+ORJSON_OPTIONS = orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY if orjson else None
+
+def is_null(v):
+    if v is None:
+        return True
+    if isinstance(v, (str, int, dict, list)):
+        return False
+    # NaN, NaT
+    return v != v
+
+def prune_nulls(elt):
+    """Copy of elt without the None / NaN values of its dicts, as clean_json does in place."""
+    if isinstance(elt, dict):
+        return {k: prune_nulls(v) for k, v in elt.items() if not is_null(v)}
+    if isinstance(elt, list):
+        return [prune_nulls(v) for v in elt]
+    return elt
+
+def dumps_jsonl(elt, prune = True) -> bytes:
+    """elt as a json line, elt itself is not modified."""
+    if prune:
+        elt = prune_nulls(elt)
+    if JSON_BACKEND == 'orjson':
+        try:
+            return orjson.dumps(elt, option=ORJSON_OPTIONS) + b'\n'
+        except TypeError:
+            # e.g. integers over 64 bits, left to the standard encoder
+            pass
+    return json.dumps(elt).encode('utf-8') + b'\n'
+
+def loads_json(line):
+    if JSON_BACKEND == 'orjson':
+        return orjson.loads(line)
+    return json.loads(line)
+
+class JsonlWriter:
+    """Buffered binary jsonl writer, gzipped when the filename ends with .gz.
+
+    Lines are encoded by dumps_jsonl and written by batches of batch_size.
+    """
+
+    def __init__(self, filename, mode = 'w', batch_size = 1000):
+        self.filename = filename
+        if filename.endswith('.gz'):
+            self.f = gzip.open(filename, f'{mode}b', compresslevel=6)
+        else:
+            self.f = open(filename, f'{mode}b', buffering=1024*1024)
+        self.batch_size = batch_size
+        self.batch = []
+        self.nb_written = 0
+
+    def write(self, elt, prune = True):
+        self.write_line(dumps_jsonl(elt, prune))
+
+    def write_line(self, line: bytes):
+        self.batch.append(line)
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self.batch:
+            self.f.write(b''.join(self.batch))
+            self.nb_written += len(self.batch)
+            self.batch = []
+
+    def close(self):
+        self.flush()
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+class TeeWriter:
+    """Writes each element once serialized to several sinks.
+
+    A sink is anything with write_line(bytes) and close(): a JsonlWriter on a local file,
+    a custom path or a .gz artifact, or a loader consuming the lines. Sinks are closed
+    with the TeeWriter.
+    """
+
+    def __init__(self, sinks):
+        self.sinks = [sink for sink in sinks if sink is not None]
+        self.nb_written = 0
+
+    def write(self, elt, prune = True):
+        self.write_line(dumps_jsonl(elt, prune))
+
+    def write_line(self, line: bytes):
+        for sink in self.sinks:
+            sink.write_line(line)
+        self.nb_written += 1
+
+    def close(self):
+        for sink in self.sinks:
+            sink.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
 def to_jsonl(input_list, output_file, mode = 'a'):
-    with open(output_file, mode) as outfile:
+    with JsonlWriter(output_file, mode) as writer:
         for entry in input_list:
-            new = clean_json(entry)
-            json.dump(new, outfile)
-            outfile.write('\n')
+            writer.write(entry)
 
 def dedup_sort(x: list) -> list:
     y = list(set([e for e in x if e]))
@@ -163,15 +352,32 @@ normalizer = Sequence([BertNormalizer(clean_text=True,
 pre_tokenizer = pre_tokenizers.Sequence([Whitespace()])
 
 
+# distinct strings normalized are memoized, there are only a few thousand mentions
+NORMALIZE_CACHE_SIZE = int(os.getenv('NORMALIZE_CACHE_SIZE', 65536))
+# one pass for what was done by successive replaces: new lines and punctuation to spaces, then ’ to '
+NORMALIZE_TABLE = str.maketrans({**{p: ' ' for p in string.punctuation}, '\n': ' ', '’': "'"})
+
+
 def normalize(x, remove_space = True, min_length = 0):
     if not isinstance(x, str):
         return ''
-    normalized = normalizer.normalize_str(x)
-    normalized = normalized.replace('\n', ' ')
-    normalized = re.sub(' +', ' ', normalized)
-    normalized = remove_punction(normalized)
-    normalized = normalized.replace("’", "'")
-    normalized = " ".join([e[0] for e in pre_tokenizer.pre_tokenize_str(normalized) if len(e[0]) > min_length])
+    return normalize_str(x, remove_space, min_length)
+
+
+@lru_cache(maxsize=NORMALIZE_CACHE_SIZE)
+def normalize_str(x: str, remove_space: bool, min_length: int) -> str:
+    # the pre-tokenizer splits on whitespace, so runs of spaces need no collapsing
+    normalized = normalizer.normalize_str(x).translate(NORMALIZE_TABLE)
+    tokens = [e[0] for e in pre_tokenizer.pre_tokenize_str(normalized) if len(e[0]) > min_length]
     if remove_space:
-        normalized = normalized.strip().replace(' ', '')
-    return normalized
+        return ''.join(tokens)
+    return ' '.join(tokens)
+
+
+def normalize_batch(values: list, remove_space: bool = True, min_length: int = 0) -> list:
+    """normalize each value, distinct values being normalized once."""
+    normalized = {}
+    for x in values:
+        if isinstance(x, str) and x not in normalized:
+            normalized[x] = normalize_str(x, remove_space, min_length)
+    return [normalized.get(x, '') if isinstance(x, str) else '' for x in values]
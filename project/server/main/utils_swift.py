@@ -62,6 +62,15 @@ def download_object(container: str, filename: str, out: str) -> None:
     os.system(cmd)
 
 
+@retry(delay=2, tries=50)
+def copy_object(container: str, source: str, target: str) -> str:
+    """Server-side copy, no data goes through the worker."""
+    logger.debug(f'Copying {source} to {target} in {container}')
+    connection = get_connection()
+    connection.copy_object(container, source, destination=f'/{container}/{target}')
+    return f'https://storage.gra.cloud.ovh.net/v1/AUTH_{project_id}/{container}/{target}'
+
+
 @retry(delay=2, tries=50)
 def get_objects(container: str, path: str) -> list:
     try: